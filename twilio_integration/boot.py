@@ -1,9 +1,11 @@
 from __future__ import unicode_literals
 import frappe
+from twilio_integration.twilio_integration.utils import get_twilio_settings
+from twilio_integration.twilio_integration.twilio_handler import get_voice_profile
 
 def boot_session(bootinfo):
 	"""Include twilio enabled flag into boot.
 	"""
-	twilio_settings_enabled = frappe.db.get_single_value('Twilio Settings', 'enabled')
-	twilio_enabled_for_user = frappe.db.get_value('Voice Call Settings', frappe.session.user, 'twilio_number')
+	twilio_settings_enabled = get_twilio_settings().enabled
+	twilio_enabled_for_user = get_voice_profile(frappe.session.user)['enabled']
 	bootinfo.twilio_enabled = twilio_settings_enabled and twilio_enabled_for_user
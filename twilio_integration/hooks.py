@@ -13,7 +13,8 @@ app_license = "MIT"
 fixtures = [{"dt": "Custom Field", "filters": [
 		[
 			"name", "in", [
-				"Notification-twilio_number", "Voice Call Settings-twilio_number"
+				"Notification-twilio_number", "Notification-whatsapp_message_template",
+				"Voice Call Settings-twilio_number"
 			]
 		]
 	]}
@@ -99,10 +100,47 @@ doctype_js = {
 # 		"on_trash": "method"
 #	}
 # }
+doc_events = {
+	"Voice Call Settings": {
+		"on_update": "twilio_integration.twilio_integration.twilio_handler.on_voice_call_settings_update",
+		"on_trash": "twilio_integration.twilio_integration.twilio_handler.on_voice_call_settings_update"
+	},
+	"User": {
+		"on_update": "twilio_integration.twilio_integration.twilio_handler.on_user_update",
+		"on_trash": "twilio_integration.twilio_integration.twilio_handler.clear_routing_cache"
+	},
+	"DocType": {
+		"on_update": "twilio_integration.twilio_integration.doctype.whatsapp_campaign.whatsapp_campaign.clear_whatsapp_doctypes_cache",
+		"on_trash": "twilio_integration.twilio_integration.doctype.whatsapp_campaign.whatsapp_campaign.clear_whatsapp_doctypes_cache"
+	},
+	"Contact": {
+		"on_update": "twilio_integration.twilio_integration.contact_index.update_contact_phone_index",
+		"on_trash": "twilio_integration.twilio_integration.contact_index.update_contact_phone_index",
+		"after_rename": "twilio_integration.twilio_integration.contact_index.rename_contact_phone_index"
+	},
+	"File": {
+		"validate": "twilio_integration.overrides.notification.validate_notification_attachment",
+		"on_update": "twilio_integration.overrides.notification.clear_notification_media",
+		"on_trash": "twilio_integration.overrides.notification.clear_notification_media"
+	},
+	"Custom Field": {
+		"on_update": "twilio_integration.twilio_integration.doctype.whatsapp_campaign.whatsapp_campaign.clear_whatsapp_doctypes_cache",
+		"on_trash": "twilio_integration.twilio_integration.doctype.whatsapp_campaign.whatsapp_campaign.clear_whatsapp_doctypes_cache"
+	}
+}
 
 # Scheduled Tasks
 # ---------------
 
+scheduler_events = {
+	"cron": {
+		"* * * * *": [
+			"twilio_integration.twilio_integration.doctype.whatsapp_campaign.whatsapp_campaign.send_scheduled_campaigns",
+			"twilio_integration.twilio_integration.api.requeue_whatsapp_status_retries"
+		]
+	}
+}
+
 # scheduler_events = {
 # 	"all": [
 # 		"twilio_integration.tasks.all"
@@ -151,3 +189,7 @@ override_doctype_class = {
 # boot
 # ----------
 boot_session = "twilio_integration.boot.boot_session"
+
+# sessions
+# ----------
+on_logout = "twilio_integration.twilio_integration.twilio_handler.on_logout"
@@ -1,17 +1,38 @@
 import frappe
 from frappe import _
 from frappe.email.doctype.notification.notification import Notification, get_context, json
-from twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message import WhatsAppMessage
+from twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message import WhatsAppMessage, queue_whatsapp_message
+from twilio_integration.twilio_integration.utils import get_twilio_settings
+from twilio_integration.twilio_integration.media import get_attachment, get_media_url, validate_media
+from twilio_integration.twilio_integration.message_template import get_compiled_template, get_message_template
+
+# Media URL of the attachment of every WhatsApp notification ('' when there is none), resolved after
+# the notification or its attachment is saved instead of on every send.
+NOTIFICATION_MEDIA_CACHE_KEY = 'twilio_notification_media'
 
 class SendNotification(Notification):
 	def validate(self):
 		self.validate_twilio_settings()
+		self.validate_whatsapp_media()
+
+	def on_update(self):
+		super(SendNotification, self).on_update()
+		clear_notification_media_cache(self.name)
+
+	def on_trash(self):
+		super(SendNotification, self).on_trash()
+		clear_notification_media_cache(self.name)
 
 	def validate_twilio_settings(self):
 		if self.enabled and self.channel == "WhatsApp" \
-			and not frappe.db.get_single_value("Twilio Settings", "enabled"):
+			and not get_twilio_settings().enabled:
 			frappe.throw(_("Please enable Twilio settings to send WhatsApp messages"))
 
+	def validate_whatsapp_media(self):
+		attachment = self.channel == "WhatsApp" and not self.is_new() and get_attachment(self.doctype, self.name)
+		if attachment:
+			validate_media(attachment)
+
 	def send(self, doc):
 		context = get_context(doc)
 		context = {"doc": doc, "alert": self, "comments": None}
@@ -29,10 +50,61 @@ class SendNotification(Notification):
 
 		super(SendNotification, self).send(doc)
 
+	def get_whatsapp_template(self):
+		"""Compiled message template, compiled once and reused till the notification or the template is modified.
+		"""
+		if self.get('whatsapp_message_template'):
+			return get_message_template(self.whatsapp_message_template)
+		return get_compiled_template(('Notification', self.name), self.message, self.modified)
+
 	def send_whatsapp_msg(self, doc, context):
+		receiver_list = self.get_receiver_list(doc, context)
+		message = self.get_whatsapp_template().render(context)
+		media = get_notification_media(self.name)
+
+		if get_twilio_settings().send_notifications_in_background:
+			# All notifications of a document are sent together after the document is committed.
+			queue_whatsapp_message(receiver_list, message, self.doctype, self.name, media=media,
+				group=(doc.doctype, doc.name))
+			return
+
 		WhatsAppMessage.send_whatsapp_message(
-			receiver_list=self.get_receiver_list(doc, context),
-			message=frappe.render_template(self.message, context),
+			receiver_list=receiver_list,
+			message=message,
 			doctype = self.doctype,
-			docname = self.name
-		)
\ No newline at end of file
+			docname = self.name,
+			media = media
+		)
+
+def get_notification_media(notification):
+	return frappe.cache().hget(NOTIFICATION_MEDIA_CACHE_KEY, notification,
+		generator=lambda: get_notification_media_from_db(notification)) or None
+
+def get_notification_media_from_db(notification):
+	attachment = get_attachment('Notification', notification)
+	return (attachment and get_media_url(attachment)) or ''
+
+def validate_notification_attachment(doc, method=None):
+	"""Validate files attached to WhatsApp notifications (File `validate`).
+	"""
+	if doc.attached_to_doctype == 'Notification' and \
+		frappe.db.get_value('Notification', doc.attached_to_name, 'channel') == 'WhatsApp':
+		validate_media(doc)
+
+def clear_notification_media(doc, method=None):
+	"""Resolve the media of the notification again when its attachment changes (File `on_update` and `on_trash`).
+	"""
+	if doc.attached_to_doctype == 'Notification' and doc.attached_to_name:
+		clear_notification_media_cache(doc.attached_to_name)
+
+def clear_notification_media_cache(notification):
+	# Other processes may cache the old media before this transaction is committed, so the media
+	# is dropped once again and resolved by a job after the commit.
+	frappe.cache().hdel(NOTIFICATION_MEDIA_CACHE_KEY, notification)
+	frappe.enqueue('twilio_integration.overrides.notification.refresh_notification_media',
+		queue='short', enqueue_after_commit=True, notification=notification)
+
+def refresh_notification_media(notification):
+	frappe.cache().hdel(NOTIFICATION_MEDIA_CACHE_KEY, notification)
+	if frappe.db.get_value('Notification', notification, 'channel') == 'WhatsApp':
+		get_notification_media(notification)
@@ -0,0 +1,27 @@
+import frappe
+from twilio_integration.twilio_integration.utils import bulk_update_values
+from twilio_integration.twilio_integration.doctype.whatsapp_conversation.whatsapp_conversation import set_conversation, \
+	update_conversations
+
+def execute():
+	"""Link existing WhatsApp messages to conversations, oldest first so that the latest message ends up as the last message.
+	"""
+	frappe.reload_doc('twilio_integration', 'doctype', 'whatsapp_conversation')
+	frappe.reload_doc('twilio_integration', 'doctype', 'whatsapp_message')
+
+	while True:
+		messages = frappe.get_all('WhatsApp Message',
+			filters={'conversation': ['is', 'not set']},
+			fields=['name', 'from_', 'to', 'message', 'sent_received', 'profile_name', 'send_on', 'creation'],
+			order_by='creation asc',
+			limit_page_length=5000
+		)
+		if not messages:
+			break
+
+		set_conversation(messages)
+		bulk_update_values('WhatsApp Message', {m.name: {'conversation': m.conversation} for m in messages})
+		update_conversations(messages)
+
+	# Old messages are not unread.
+	frappe.db.sql("""UPDATE `tabWhatsApp Conversation` SET `unread_count` = 0""")
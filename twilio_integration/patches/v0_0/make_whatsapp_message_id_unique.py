@@ -0,0 +1,17 @@
+import frappe
+
+def execute():
+	"""Clear blank and duplicate message ids so that a unique index can be added on `id`.
+	Duplicates were created when twilio retried incoming message webhooks, the oldest message keeps the id.
+	"""
+	if not frappe.db.table_exists('WhatsApp Message'):
+		return
+
+	frappe.db.sql("""UPDATE `tabWhatsApp Message` SET `id` = NULL WHERE `id` = ''""")
+
+	duplicate_ids = frappe.db.sql_list("""SELECT `id` FROM `tabWhatsApp Message`
+		WHERE `id` IS NOT NULL GROUP BY `id` HAVING COUNT(*) > 1""")
+	for sid in duplicate_ids:
+		names = frappe.get_all('WhatsApp Message', filters={'id': sid}, order_by='creation asc', pluck='name')
+		frappe.db.sql("""UPDATE `tabWhatsApp Message` SET `id` = NULL WHERE `name` IN %(names)s""",
+			{'names': names[1:]})
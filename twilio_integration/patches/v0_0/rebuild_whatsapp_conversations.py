@@ -0,0 +1,26 @@
+import frappe
+from twilio_integration.patches.v0_0 import create_whatsapp_conversations
+from twilio_integration.twilio_integration.doctype.whatsapp_conversation.whatsapp_conversation import \
+	get_conversation_name, normalize_whatsapp_address
+
+def execute():
+	"""Conversations are named after the full digest of the normalized numbers, link the messages again.
+	"""
+	frappe.reload_doc('twilio_integration', 'doctype', 'whatsapp_conversation')
+	frappe.reload_doc('twilio_integration', 'doctype', 'whatsapp_message')
+
+	unread = frappe.get_all('WhatsApp Conversation',
+		filters={'unread_count': ['>', 0]},
+		fields=['business_number', 'customer_number', 'unread_count']
+	)
+
+	frappe.db.sql("""UPDATE `tabWhatsApp Message` SET `conversation` = NULL""")
+	frappe.db.sql("""DELETE FROM `tabWhatsApp Conversation`""")
+	create_whatsapp_conversations.execute()
+
+	# Keep the unread messages unread.
+	for conversation in unread:
+		name = get_conversation_name(normalize_whatsapp_address(conversation.business_number),
+			normalize_whatsapp_address(conversation.customer_number))
+		frappe.db.sql("""UPDATE `tabWhatsApp Conversation` SET `unread_count` = `unread_count` + %s
+			WHERE `name` = %s""", (conversation.unread_count, name))
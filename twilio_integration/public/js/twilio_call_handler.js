@@ -2,18 +2,60 @@ var onload_script = function() {
 	frappe.provide('frappe.phone_call');
 	frappe.provide('frappe.twilio_conn_dialog_map')
 	let device;
+	let heartbeat_timer;
+	let token_refresh_timer;
+	const heartbeat_interval = 30 * 1000;
 
 	if (frappe.boot.twilio_enabled){
 		frappe.run_serially([
 			() => setup_device(),
-			() => dialer_screen()
+			() => dialer_screen(),
+			() => setup_call_status_updates()
 		]);
 	}
 
+	// Heartbeat only tells that the softphone is online, the server tracks whether the agent is on a call.
+	function send_heartbeat(status) {
+		frappe.call({
+			method: "twilio_integration.twilio_integration.api.agent_heartbeat",
+			args: {
+				status: status || 'available'
+			},
+			type: "POST",
+			freeze: false,
+			async: true
+		});
+	}
+
+	function setup_heartbeat() {
+		send_heartbeat();
+		// `ready` is emitted again whenever the device reconnects, keep a single timer.
+		if (heartbeat_timer) return;
+		heartbeat_timer = setInterval(() => send_heartbeat(), heartbeat_interval);
+	}
+
+	function schedule_token_refresh(expires_in) {
+		// Refresh two minutes ahead of expiry, server reissues tokens that are about to expire.
+		clearTimeout(token_refresh_timer);
+		token_refresh_timer = setTimeout(() => refresh_token(), Math.max(expires_in - 120, 30) * 1000);
+	}
+
+	function refresh_token() {
+		frappe.call({
+			method: "twilio_integration.twilio_integration.api.refresh_access_token",
+			callback: (data) => {
+				if (!(data.message && data.message.token)) return;
+				device.updateToken(data.message.token);
+				schedule_token_refresh(data.message.expires_in);
+			}
+		});
+	}
+
 	function setup_device() {
 		frappe.call( {
 			method: "twilio_integration.twilio_integration.api.generate_access_token",
 			callback: (data) => {
+				schedule_token_refresh(data.message.expires_in);
 				device = new Twilio.Device(data.message.token, {
 					codecPreferences: ["opus", "pcmu"],
 					fakeLocalDTMF: true,
@@ -21,11 +63,18 @@ var onload_script = function() {
 				});
 
 				device.on("ready", function (device) {
+					setup_heartbeat();
 					Object.values(frappe.twilio_conn_dialog_map).forEach(function(popup){
 						popup.set_header('available');
 					})
 				});
 
+				device.on("offline", function () {
+					clearInterval(heartbeat_timer);
+					heartbeat_timer = null;
+					send_heartbeat('offline');
+				});
+
 				device.on("error", function (error) {
 					Object.values(frappe.twilio_conn_dialog_map).forEach(function(popup){
 						popup.set_header('Failed');
@@ -35,7 +84,6 @@ var onload_script = function() {
 				});
 
 				device.on("disconnect", function (conn) {
-					update_call_log(conn);
 					const popup = frappe.twilio_conn_dialog_map[conn];
 					// Reomove the connection from map object
 					delete frappe.twilio_conn_dialog_map[conn]
@@ -103,15 +151,20 @@ var onload_script = function() {
 		}
 	}
 
-	function update_call_log(conn, status="Completed") {
-		if (!conn.parameters.CallSid) return
-		frappe.call({
-			"method": "twilio_integration.twilio_integration.api.update_call_log",
-			"args": {
-				"call_sid": conn.parameters.CallSid,
-				"status": status
-			}
-		})
+	function setup_call_status_updates() {
+		// Status of the dialed number or agent is pushed by the server as twilio reports it.
+		frappe.realtime.on('twilio_call_status', (data) => {
+			const popups = Object.values(frappe.twilio_conn_dialog_map);
+			data.updates.forEach((update) => {
+				if (!update.status) return;
+				popups.forEach((popup) => {
+					const call_sid = popup.conn && popup.conn.parameters.CallSid;
+					if (call_sid && [update.call_sid, update.leg_sid].includes(call_sid)) {
+						popup.set_header(frappe.scrub(update.status, '-'));
+					}
+				});
+			});
+		});
 	}
 
 	function call_screen(conn) {
@@ -282,6 +335,7 @@ class OutgoingCallPopup extends TwilioCallPopup {
 				if (this.twilio_device) {
 					let me = this;
 					let outgoingConnection = this.twilio_device.connect(params);
+					this.conn = outgoingConnection;
 					frappe.twilio_conn_dialog_map[outgoingConnection] = this;
 					outgoingConnection.on("ringing", function () {
 						me.set_header('ringing');
@@ -1,12 +1,22 @@
+import time
 from werkzeug.wrappers import Response
 
 import frappe
 from frappe import _
-from frappe.contacts.doctype.contact.contact import get_contact_with_phone_number
-from .twilio_handler import Twilio, IncomingCall, TwilioCallDetails
-from twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message import incoming_message_callback
+from frappe.realtime import get_doctype_room, get_user_room
+from .twilio_handler import Twilio, IncomingCall, TwilioCallDetails, set_agent_presence, set_agent_on_call, \
+	get_voice_profile
+from .contact_index import get_contact_by_phone, get_contacts_by_phone
+from .utils import push_to_buffer, flush_buffer, retry_later, requeue_retries, set_once, get_twilio_settings, publish_status_updates
+from twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message import incoming_message_callback, store_incoming_messages, apply_status_updates
 from twilio.twiml.messaging_response import MessagingResponse
 
+CALL_LOG_BUFFER_KEY = 'twilio_call_log_buffer'
+WHATSAPP_STATUS_BUFFER_KEY = 'twilio_whatsapp_status_buffer'
+WHATSAPP_INCOMING_BUFFER_KEY = 'twilio_whatsapp_incoming_buffer'
+# Status of a message that is not saved yet is retried for a while before it is dropped.
+WHATSAPP_STATUS_RETRY_SECONDS = 30 * 60
+
 @frappe.whitelist()
 def get_twilio_phone_numbers():
 	twilio = Twilio.connect()
@@ -20,7 +30,7 @@ def generate_access_token():
 	if not twilio:
 		return {}
 
-	from_number = frappe.db.get_value('Voice Call Settings', frappe.session.user, 'twilio_number')
+	from_number = get_voice_profile(frappe.session.user)['twilio_number']
 	if not from_number:
 		return {
 			"ok": False,
@@ -28,11 +38,33 @@ def generate_access_token():
 			"detail": "Phone number is not mapped to the caller"
 		}
 
-	token=twilio.generate_voice_access_token(from_number=from_number, identity=frappe.session.user)
+	return get_voice_access_token(twilio)
+
+@frappe.whitelist()
+def refresh_access_token():
+	"""Called by the browser softphone shortly before its access token expires.
+	"""
+	twilio = Twilio.connect()
+	if not (twilio and get_voice_profile(frappe.session.user)['enabled']):
+		return {}
+	return get_voice_access_token(twilio)
+
+def get_voice_access_token(twilio):
+	token = twilio.get_voice_access_token(frappe.session.user)
 	return {
-		'token': frappe.safe_decode(token)
+		'token': token['token'],
+		'expires_in': int(token['expires_at'] - time.time())
 	}
 
+@frappe.whitelist()
+def agent_heartbeat(status='available'):
+	"""Called periodically by the browser softphone to mark the agent as online.
+	Whether the agent is on a call is tracked from call status callbacks instead.
+	"""
+	if status not in ('available', 'busy', 'offline'):
+		frappe.throw(_('Invalid agent status {0}').format(status))
+	set_agent_presence(frappe.session.user, 'offline' if status == 'offline' else 'available')
+
 @frappe.whitelist(allow_guest=True)
 def voice(**kwargs):
 	"""This is a webhook called by twilio to get instructions when the voice call request comes to twilio server.
@@ -40,7 +72,7 @@ def voice(**kwargs):
 	def _get_caller_number(caller):
 		identity = caller.replace('client:', '').strip()
 		user = Twilio.emailid_from_identity(identity)
-		return frappe.db.get_value('Voice Call Settings', user, 'twilio_number')
+		return get_voice_profile(user)['twilio_number']
 
 	args = frappe._dict(kwargs)
 	twilio = Twilio.connect()
@@ -52,38 +84,110 @@ def voice(**kwargs):
 
 	# Generate TwiML instructions to make a call
 	from_number = _get_caller_number(args.Caller)
-	resp = twilio.generate_twilio_dial_response(from_number, args.To)
+	identity = args.Caller.replace('client:', '').strip()
+	resp = twilio.generate_twilio_dial_response(from_number, args.To, identity=identity)
+	set_agent_on_call(Twilio.emailid_from_identity(identity))
 
 	call_details = TwilioCallDetails(args, call_from=from_number)
-	create_call_log(call_details)
+	buffer_call_log(call_details)
 	return Response(resp.to_xml(), mimetype='text/xml')
 
 @frappe.whitelist(allow_guest=True)
 def twilio_incoming_call_handler(**kwargs):
 	args = frappe._dict(kwargs)
+	if args.AccountSid != get_twilio_settings().account_sid:
+		return
+
 	call_details = TwilioCallDetails(args)
-	create_call_log(call_details)
+	buffer_call_log(call_details)
 
 	resp = IncomingCall(args.From, args.To).process()
 	return Response(resp.to_xml(), mimetype='text/xml')
 
-@frappe.whitelist()
-def create_call_log(call_details: TwilioCallDetails):
-	call_log = frappe.get_doc({**call_details.to_dict(),
-		'doctype': 'Call Log',
-		'medium': 'Twilio'
-	})
+def buffer_call_log(call_details: TwilioCallDetails):
+	"""Queue the call log to be saved by a background job, so that webhooks respond without writing to database.
+	Twilio retries webhooks, so a call is logged only once.
+	"""
+	if not set_once('twilio_call_log_' + call_details.call_sid):
+		return
+	push_to_buffer(CALL_LOG_BUFFER_KEY, call_details.to_dict(),
+		'twilio_integration.twilio_integration.api.flush_call_log_buffer')
 
-	call_log.flags.ignore_permissions = True
-	call_log.save()
-	frappe.db.commit()
+def flush_call_log_buffer():
+	"""Save buffered call logs in batches.
+	"""
+	flush_buffer(CALL_LOG_BUFFER_KEY, save_call_logs)
+
+def save_call_logs(events):
+	"""Insert new call logs and update the existing ones, latest event of a call wins.
+	Status changes are published to the agents on the call.
+	"""
+	call_logs, updates = {}, {}
+	for event in events:
+		leg_sid, user = event.get('leg_id'), event.get('user')
+		call_logs.setdefault(event['id'], {}).update({k: v for k, v in event.items()
+			if v is not None and k not in ('leg_id', 'user')})
+		if user:
+			updates.setdefault(user, []).append({
+				'call_sid': event['id'],
+				'leg_sid': leg_sid,
+				'status': event.get('status'),
+				'duration': event.get('duration')
+			})
+
+	existing = set(frappe.get_all('Call Log', filters={'name': ['in', list(call_logs)]}, pluck='name'))
+	for call_sid, values in call_logs.items():
+		if call_sid in existing:
+			values.pop('id', None)
+			frappe.db.set_value('Call Log', call_sid, values)
+			continue
+
+		# Status of a call that was never logged.
+		if not values.get('type'):
+			continue
+
+		call_log = frappe.get_doc({**values,
+			'doctype': 'Call Log',
+			'medium': 'Twilio'
+		})
+		call_log.flags.ignore_permissions = True
+		call_log.insert()
+
+	for user, user_updates in updates.items():
+		publish_status_updates('twilio_call_status', user_updates, get_user_room(user))
+
+@frappe.whitelist(allow_guest=True)
+def call_status_callback(**kwargs):
+	"""This is a webhook called by Twilio when a dialed agent or number answers or the call ends.
+	Status is buffered and saved by a background job, which also publishes it to the agent's softphone.
+	"""
+	args = frappe._dict(kwargs)
+	if args.AccountSid != get_twilio_settings().account_sid:
+		return
+
+	status = TwilioCallDetails.get_call_status(args.CallStatus)
+	user = args.agent and Twilio.emailid_from_identity(args.agent)
+	if user:
+		set_agent_on_call(user, status in ('Ringing', 'In Progress'))
+
+	push_to_buffer(CALL_LOG_BUFFER_KEY, {
+			'id': args.ParentCallSid or args.CallSid,
+			'leg_id': args.CallSid,
+			'status': status,
+			'duration': args.CallDuration,
+			'user': user
+		},
+		'twilio_integration.twilio_integration.api.flush_call_log_buffer')
 
 @frappe.whitelist()
 def update_call_log(call_sid, status=None):
 	"""Update call log status.
 	"""
 	twilio = Twilio.connect()
-	if not (twilio and frappe.db.exists("Call Log", call_sid)): return
+	if not twilio: return
+
+	# Call log of a short call can still be in the buffer, it is saved with the status of the call.
+	if not frappe.db.exists("Call Log", call_sid): return
 
 	call_details = twilio.get_call_info(call_sid)
 	call_log = frappe.get_doc("Call Log", call_sid)
@@ -97,10 +201,9 @@ def update_call_log(call_sid, status=None):
 def update_recording_info(**kwargs):
 	try:
 		args = frappe._dict(kwargs)
-		recording_url = args.RecordingUrl
-		call_sid = args.CallSid
-		update_call_log(call_sid)
-		frappe.db.set_value("Call Log", call_sid, "recording_url", recording_url)
+		# Saved by the background job after the call log, which can still be in the buffer.
+		push_to_buffer(CALL_LOG_BUFFER_KEY, {'id': args.CallSid, 'recording_url': args.RecordingUrl},
+			'twilio_integration.twilio_integration.api.flush_call_log_buffer')
 	except:
 		frappe.log_error(title=_("Failed to capture Twilio recording"))
 
@@ -108,13 +211,21 @@ def update_recording_info(**kwargs):
 def get_contact_details(phone):
 	"""Get information about existing contact in the system.
 	"""
-	contact = get_contact_with_phone_number(phone.strip())
-	if not contact: return
-	contact_doc = frappe.get_doc('Contact', contact)
-	return contact_doc and {
-		'first_name': contact_doc.first_name.title(),
-		'email_id': contact_doc.email_id,
-		'phone_number': contact_doc.phone
+	contact = get_contact_by_phone(phone.strip())
+	return contact and get_contact_dict(contact)
+
+@frappe.whitelist()
+def get_contact_details_for_numbers(numbers):
+	"""Get contact information of many phone numbers at once, used to enrich message and call lists.
+	"""
+	numbers = frappe.parse_json(numbers)
+	return {number: get_contact_dict(contact) for number, contact in get_contacts_by_phone(numbers).items()}
+
+def get_contact_dict(contact):
+	return {
+		'first_name': (contact.first_name or '').title(),
+		'email_id': contact.email_id,
+		'phone_number': contact.phone
 	}
 
 @frappe.whitelist(allow_guest=True)
@@ -122,18 +233,70 @@ def incoming_whatsapp_message_handler(**kwargs):
 	"""This is a webhook called by Twilio when a WhatsApp message is received.
 	"""
 	args = frappe._dict(kwargs)
-	incoming_message_callback(args)
+	twilio_settings = get_twilio_settings()
+	if twilio_settings.save_incoming_messages_in_background:
+		buffer_incoming_message(args)
+	else:
+		incoming_message_callback(args)
 	resp = MessagingResponse()
 
 	# Add a message
-	resp.message(frappe.db.get_single_value('Twilio Settings', 'reply_message'))
+	resp.message(twilio_settings.reply_message)
 	return Response(resp.to_xml(), mimetype='text/xml')
 
+def buffer_incoming_message(args):
+	"""Queue the incoming message to be saved by a background job, retried webhooks are dropped.
+	"""
+	if not (args.MessageSid and set_once('twilio_whatsapp_incoming_' + args.MessageSid)):
+		return
+	push_to_buffer(WHATSAPP_INCOMING_BUFFER_KEY, {
+			'id': args.MessageSid,
+			'from_': args.From,
+			'to': args.To,
+			'message': args.Body,
+			'profile_name': args.ProfileName,
+			'send_on': frappe.utils.now()
+		},
+		'twilio_integration.twilio_integration.api.flush_incoming_whatsapp_buffer')
+
+def flush_incoming_whatsapp_buffer():
+	flush_buffer(WHATSAPP_INCOMING_BUFFER_KEY, store_incoming_messages)
+
 @frappe.whitelist(allow_guest=True)
 def whatsapp_message_status_callback(**kwargs):
 	"""This is a webhook called by Twilio whenever sent WhatsApp message status is changed.
+	Status is buffered and applied to messages in batches by a background job.
 	"""
 	args = frappe._dict(kwargs)
-	if frappe.db.exists({'doctype': 'WhatsApp Message', 'id': args.MessageSid, 'from_': args.From, 'to': args.To}):
-		message = frappe.get_doc('WhatsApp Message', {'id': args.MessageSid, 'from_': args.From, 'to': args.To})
-		message.db_set('status', args.MessageStatus.title())
\ No newline at end of file
+	push_to_buffer(WHATSAPP_STATUS_BUFFER_KEY, {
+			'id': args.MessageSid,
+			'status': args.MessageStatus,
+			'received_on': time.time()
+		},
+		'twilio_integration.twilio_integration.api.flush_whatsapp_status_buffer')
+
+def flush_whatsapp_status_buffer():
+	"""Apply buffered status events in batches. Events of messages that are not saved yet
+	are retried by `requeue_whatsapp_status_retries` till they expire, expired ones are logged.
+	"""
+	expired = []
+
+	def _apply(events):
+		updates, unknown = apply_status_updates(events)
+		publish_status_updates('whatsapp_message_status', updates, get_doctype_room('WhatsApp Message'))
+
+		retry_after = time.time() - WHATSAPP_STATUS_RETRY_SECONDS
+		retry_later(WHATSAPP_STATUS_BUFFER_KEY, [e for e in unknown if (e.get('received_on') or 0) > retry_after])
+		expired.extend(e for e in unknown if (e.get('received_on') or 0) <= retry_after)
+
+	flush_buffer(WHATSAPP_STATUS_BUFFER_KEY, _apply, batch_size=5000)
+
+	if expired:
+		frappe.log_error(title=_('Status of unknown WhatsApp messages dropped'),
+			message=frappe.as_json(expired))
+
+def requeue_whatsapp_status_retries():
+	"""Scheduled every minute to retry status events of messages that were not saved yet.
+	"""
+	requeue_retries(WHATSAPP_STATUS_BUFFER_KEY,
+		'twilio_integration.twilio_integration.api.flush_whatsapp_status_buffer')
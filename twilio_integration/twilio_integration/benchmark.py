@@ -0,0 +1,360 @@
+"""Benchmarks of the webhooks, campaign fan-out and notification dispatch against the fake Twilio server.
+
+Run on a test site (`allow_tests` in site config, records are created and Twilio Settings are overwritten)
+with background workers running and the site pointed at the fake server (see `fake_twilio.py`):
+
+	bench --site test_site set-config allow_tests true
+	bench --site test_site set-config twilio_transport_url http://localhost:8089
+	bench --site test_site execute twilio_integration.twilio_integration.benchmark.run --kwargs "{'iterations': 500}"
+
+Reports p50/p99 latency and database queries per request of every scenario, and messages per second of
+campaigns and notifications. Results are written to a JSON file to compare runs between releases.
+"""
+import json
+import math
+import time
+import uuid
+
+import frappe
+from frappe.utils import get_datetime, now_datetime
+from . import api
+from .twilio_handler import set_agent_presence, set_agent_on_call
+from .utils import get_twilio_settings
+
+BENCHMARK_NUMBER = '+15005550006'
+BENCHMARK_CONTACT = 'Twilio Benchmark'
+BENCHMARK_TEMPLATE = 'Twilio Benchmark'
+BENCHMARK_NOTIFICATION = 'Twilio Benchmark'
+BUFFER_KEYS = (api.CALL_LOG_BUFFER_KEY, api.WHATSAPP_STATUS_BUFFER_KEY, api.WHATSAPP_INCOMING_BUFFER_KEY)
+
+
+class QueryCounter:
+	"""Count the queries run through `frappe.db.sql` within the block.
+	"""
+	def __enter__(self):
+		self.count = 0
+		sql = frappe.db.sql
+
+		def counted_sql(*args, **kwargs):
+			self.count += 1
+			return sql(*args, **kwargs)
+
+		frappe.db.sql = counted_sql
+		return self
+
+	def __exit__(self, *args):
+		del frappe.db.sql
+
+
+class Scenario:
+	def __init__(self, name):
+		self.name = name
+		self.latencies = []
+		self.queries = []
+		self.extra = {}
+
+	def measure(self, fn, *args, **kwargs):
+		"""Run `fn` like a request: fresh request cache, committed at the end.
+		"""
+		frappe.local.cache = {}
+		with QueryCounter() as counter:
+			start = time.perf_counter()
+			result = fn(*args, **kwargs)
+			frappe.db.commit()
+			self.latencies.append(time.perf_counter() - start)
+		self.queries.append(counter.count)
+		return result
+
+	def as_dict(self):
+		latencies = sorted(self.latencies)
+		result = {
+			'requests': len(latencies),
+			'p50_ms': percentile(latencies, 50) * 1000,
+			'p99_ms': percentile(latencies, 99) * 1000,
+			'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else 0,
+			'queries_per_request': sum(self.queries) / len(self.queries) if self.queries else 0,
+			'max_queries': max(self.queries or [0])
+		}
+		result.update(self.extra)
+		return result
+
+
+def percentile(values, p):
+	"""Nearest rank percentile of sorted values.
+	"""
+	if not values:
+		return 0
+	return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def run(iterations=200, recipients=1000, notifications=200, warmup=10, timeout=600, output=None):
+	"""Run all the scenarios and write the results to `output` (JSON).
+	"""
+	if not frappe.conf.allow_tests:
+		frappe.throw('Benchmarks create records and overwrite Twilio Settings, run them on a site with `allow_tests`.')
+	if not frappe.conf.twilio_transport_url:
+		frappe.throw('Set `twilio_transport_url` to a fake Twilio server, benchmarks never use the live API.')
+
+	frappe.set_user('Administrator')
+	setup()
+
+	scenarios = [
+		bench_voice(iterations, warmup),
+		bench_incoming_call(iterations, warmup),
+		bench_incoming_whatsapp_message(iterations, warmup),
+	]
+	campaign = bench_campaign(recipients, timeout)
+	scenarios.append(campaign)
+	scenarios.append(bench_whatsapp_status_callback(iterations, warmup, campaign.extra.get('campaign')))
+	scenarios.append(bench_notification(notifications, warmup))
+	scenarios.append(bench_buffer_drain(timeout))
+
+	results = {
+		'site': frappe.local.site,
+		'started_at': str(now_datetime()),
+		'app_version': frappe.get_attr('twilio_integration.__version__'),
+		'transport_url': frappe.conf.twilio_transport_url,
+		'config': {
+			'iterations': iterations,
+			'recipients': recipients,
+			'notifications': notifications,
+			'warmup': warmup
+		},
+		'scenarios': {scenario.name: scenario.as_dict() for scenario in scenarios}
+	}
+
+	output = output or 'twilio_benchmark_{0}.json'.format(now_datetime().strftime('%Y%m%d_%H%M%S'))
+	with open(output, 'w') as f:
+		json.dump(results, f, indent=1, default=str)
+
+	print_results(results)
+	print('Results written to {0}'.format(output))
+	return results
+
+
+def setup():
+	settings = frappe.get_doc('Twilio Settings')
+	settings.update({
+		'enabled': 1,
+		'account_sid': 'AC' + '0' * 32,
+		'auth_token': 'benchmark',
+		'whatsapp_no': BENCHMARK_NUMBER,
+		'reply_message': 'Thank you for your message.',
+		'record_calls': 0,
+		'save_incoming_messages_in_background': 1,
+		'send_notifications_in_background': 0
+	})
+	settings.save()
+
+	if not frappe.db.exists('Voice Call Settings', 'Administrator'):
+		frappe.get_doc({
+			'doctype': 'Voice Call Settings',
+			'user': 'Administrator',
+			'call_receiving_device': 'Computer',
+			'twilio_number': BENCHMARK_NUMBER
+		}).insert(ignore_permissions=True)
+
+	if not frappe.db.exists('Contact', BENCHMARK_CONTACT):
+		frappe.get_doc({
+			'doctype': 'Contact',
+			'first_name': BENCHMARK_CONTACT,
+			'phone_nos': [{'phone': '+15550000000', 'is_primary_mobile_no': 1}]
+		}).insert(ignore_permissions=True)
+
+	if not frappe.db.exists('WhatsApp Message Template', BENCHMARK_TEMPLATE):
+		frappe.get_doc({
+			'doctype': 'WhatsApp Message Template',
+			'template_name': BENCHMARK_TEMPLATE,
+			'message': 'Hello {{ doc.first_name }}, this is a benchmark message.'
+		}).insert(ignore_permissions=True)
+
+	if not frappe.db.exists('Notification', BENCHMARK_NOTIFICATION):
+		notification = frappe.get_doc({
+			'doctype': 'Notification',
+			'name': BENCHMARK_NOTIFICATION,
+			'subject': BENCHMARK_NOTIFICATION,
+			'document_type': 'Contact',
+			'event': 'Method',
+			'method': 'twilio_benchmark',
+			'channel': 'WhatsApp',
+			'twilio_number': BENCHMARK_NUMBER,
+			'message': 'Hello {{ doc.first_name }}, this is a benchmark notification.',
+			'recipients': [{'receiver_by_document_field': 'mobile_no'}]
+		})
+		notification.flags.ignore_links = True
+		notification.insert(ignore_permissions=True)
+
+	frappe.db.commit()
+
+
+def new_sid(prefix):
+	return prefix + uuid.uuid4().hex
+
+
+def bench_voice(iterations, warmup):
+	scenario = Scenario('voice')
+	settings = get_twilio_settings()
+	for i in range(warmup + iterations):
+		if i == warmup:
+			scenario.latencies, scenario.queries = [], []
+		scenario.measure(api.voice,
+			AccountSid=settings.account_sid,
+			ApplicationSid=settings.twiml_sid,
+			CallSid=new_sid('CA'),
+			CallStatus='ringing',
+			Caller='client:Administrator',
+			From='client:Administrator',
+			To='+1555{0:07d}'.format(i)
+		)
+	return scenario
+
+
+def bench_incoming_call(iterations, warmup):
+	scenario = Scenario('twilio_incoming_call_handler')
+	for i in range(warmup + iterations):
+		if i == warmup:
+			scenario.latencies, scenario.queries = [], []
+		# Agent is marked on a call once a call is routed to it, the status callback frees it again.
+		set_agent_presence('Administrator', 'available')
+		set_agent_on_call('Administrator', False)
+		scenario.measure(api.twilio_incoming_call_handler,
+			AccountSid=get_twilio_settings().account_sid,
+			CallSid=new_sid('CA'),
+			CallStatus='ringing',
+			Caller='+1555{0:07d}'.format(i),
+			From='+1555{0:07d}'.format(i),
+			To=BENCHMARK_NUMBER
+		)
+	set_agent_presence('Administrator', 'offline')
+	set_agent_on_call('Administrator', False)
+	return scenario
+
+
+def bench_incoming_whatsapp_message(iterations, warmup):
+	scenario = Scenario('incoming_whatsapp_message_handler')
+	for i in range(warmup + iterations):
+		if i == warmup:
+			scenario.latencies, scenario.queries = [], []
+		scenario.measure(api.incoming_whatsapp_message_handler,
+			AccountSid=get_twilio_settings().account_sid,
+			MessageSid=new_sid('SM'),
+			SmsStatus='received',
+			From='whatsapp:+1555{0:07d}'.format(i % 50),
+			To='whatsapp:' + BENCHMARK_NUMBER,
+			Body='Benchmark message {0}'.format(i),
+			ProfileName='Benchmark {0}'.format(i % 50)
+		)
+	return scenario
+
+
+def bench_whatsapp_status_callback(iterations, warmup, campaign=None):
+	scenario = Scenario('whatsapp_message_status_callback')
+	# Status of the messages sent by the campaign, or of unknown messages if it didn't send any.
+	sids = campaign and frappe.get_all('WhatsApp Message',
+		filters={'reference_doctype': 'WhatsApp Campaign', 'reference_document_name': campaign, 'id': ['is', 'set']},
+		limit_page_length=warmup + iterations,
+		pluck='id'
+	) or []
+	for i in range(warmup + iterations):
+		if i == warmup:
+			scenario.latencies, scenario.queries = [], []
+		scenario.measure(api.whatsapp_message_status_callback,
+			AccountSid=get_twilio_settings().account_sid,
+			MessageSid=sids[i] if i < len(sids) else new_sid('SM'),
+			MessageStatus='delivered'
+		)
+	return scenario
+
+
+def bench_campaign(recipients, timeout):
+	"""Latency of `send_now` and messages per second of the whole campaign, sent by background workers.
+	"""
+	scenario = Scenario('whatsapp_campaign')
+	campaign = frappe.get_doc({
+		'doctype': 'WhatsApp Campaign',
+		'template_name': BENCHMARK_TEMPLATE,
+		'message': frappe.db.get_value('WhatsApp Message Template', BENCHMARK_TEMPLATE, 'message'),
+		'audience_type': 'Recipients',
+		'recipients': [{
+			'campaign_for': 'Contact',
+			'recipient': BENCHMARK_CONTACT,
+			'whatsapp_no': '+1666{0:07d}'.format(i)
+		} for i in range(recipients)]
+	}).insert(ignore_permissions=True)
+	frappe.db.commit()
+
+	scenario.measure(campaign.send_now)
+	status = wait_for(lambda: frappe.db.get_value('WhatsApp Campaign', campaign.name, 'status') == 'Completed', timeout)
+	values = frappe.db.get_value('WhatsApp Campaign', campaign.name,
+		['total_sent', 'total_failed', 'send_on', 'completed_on'], as_dict=True)
+
+	seconds = status and (get_datetime(values.completed_on) - get_datetime(values.send_on)).total_seconds()
+	scenario.extra.update({
+		'campaign': campaign.name,
+		'recipients': recipients,
+		'completed': bool(status),
+		'sent': values.total_sent,
+		'failed': values.total_failed,
+		'seconds': seconds,
+		'messages_per_sec': values.total_sent / seconds if seconds else None
+	})
+	return scenario
+
+
+def bench_notification(notifications, warmup):
+	scenario = Scenario('notification_send')
+	notification = frappe.get_doc('Notification', BENCHMARK_NOTIFICATION)
+	contact = frappe.get_doc('Contact', BENCHMARK_CONTACT)
+	start = time.perf_counter()
+	for i in range(warmup + notifications):
+		if i == warmup:
+			scenario.latencies, scenario.queries = [], []
+			start = time.perf_counter()
+		scenario.measure(notification.send, contact)
+
+	seconds = time.perf_counter() - start
+	scenario.extra.update({
+		'seconds': seconds,
+		'messages_per_sec': notifications / seconds if seconds else None
+	})
+	return scenario
+
+
+def bench_buffer_drain(timeout):
+	"""Time taken by the background jobs to save everything buffered by the webhooks.
+	"""
+	scenario = Scenario('buffer_drain')
+	cache = frappe.cache()
+	keys = [cache.make_key(key) for key in BUFFER_KEYS]
+	pending = sum(cache.llen(key) for key in keys)
+
+	start = time.perf_counter()
+	drained = wait_for(lambda: not any(cache.llen(key) for key in keys), timeout)
+	seconds = time.perf_counter() - start
+	scenario.extra.update({
+		'items': pending,
+		'drained': drained,
+		'seconds': seconds,
+		'items_per_sec': pending / seconds if drained and seconds else None
+	})
+	return scenario
+
+
+def wait_for(condition, timeout, interval=0.5):
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		frappe.db.commit()
+		if condition():
+			return True
+		time.sleep(interval)
+	return False
+
+
+def print_results(results):
+	print('{0:<36} {1:>8} {2:>10} {3:>10} {4:>9} {5:>12}'.format(
+		'scenario', 'requests', 'p50 ms', 'p99 ms', 'queries', 'msgs/sec'))
+	for name, result in results['scenarios'].items():
+		rate = result.get('messages_per_sec') or result.get('items_per_sec')
+		print('{0:<36} {1:>8} {2:>10.2f} {3:>10.2f} {4:>9.1f} {5:>12}'.format(
+			name, result['requests'], result['p50_ms'], result['p99_ms'], result['queries_per_request'],
+			'{0:.1f}'.format(rate) if rate else '-'))
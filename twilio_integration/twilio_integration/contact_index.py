@@ -0,0 +1,144 @@
+import frappe
+from .utils import normalize_phone_number
+
+# Redis hash of normalized (E.164) phone number -> Contact, maintained by Contact hooks.
+CONTACT_PHONE_INDEX_KEY = 'twilio_contact_phone_index'
+# Marks the index as complete, stored in the same hash so that it is dropped along with it.
+INDEX_BUILT_FIELD = '__built__'
+# Set while a job to build the index is queued or running.
+INDEX_BUILD_QUEUED_KEY = 'twilio_contact_phone_index_build_queued'
+
+# Drop the numbers (ARGV[2..]) that are still mapped to the contact (ARGV[1]),
+# numbers that were taken over by another contact are left alone.
+REMOVE_CONTACT_PHONES_SCRIPT = """
+for i = 2, #ARGV do
+	if redis.call('HGET', KEYS[1], ARGV[i]) == ARGV[1] then
+		redis.call('HDEL', KEYS[1], ARGV[i])
+	end
+end
+"""
+
+# Point the numbers (ARGV[3..]) that are still mapped to the old name (ARGV[1]) of a contact to its new name (ARGV[2]).
+RENAME_CONTACT_PHONES_SCRIPT = """
+for i = 3, #ARGV do
+	if redis.call('HGET', KEYS[1], ARGV[i]) == ARGV[1] then
+		redis.call('HSET', KEYS[1], ARGV[i], ARGV[2])
+	end
+end
+"""
+
+
+def get_contact_by_phone(phone: str):
+	"""Get name, first_name, email_id and phone of the contact with the phone number.
+	"""
+	return get_contacts_by_phone([phone]).get(phone)
+
+
+def get_contacts_by_phone(numbers: list):
+	"""Map phone numbers to contact details with a single query, numbers without a contact are left out.
+	Numbers can be in any format (including `whatsapp:` addresses) but need the country code.
+	>>> get_contacts_by_phone(['whatsapp:+14155238886'])
+	{'whatsapp:+14155238886': {'name': 'John Doe', 'first_name': 'John', 'email_id': ..., 'phone': ...}}
+	"""
+	normalized = {number: normalize_phone_number(number) for number in set(numbers) if number}
+	contact_names = get_contact_names(list(set(filter(None, normalized.values()))))
+	if not contact_names:
+		return {}
+
+	contacts = {contact.name: contact for contact in frappe.get_all('Contact',
+		filters={'name': ['in', list(set(contact_names.values()))]},
+		fields=['name', 'first_name', 'email_id', 'phone']
+	)}
+	return {
+		number: contacts[contact_names[phone]] for number, phone in normalized.items()
+		if contact_names.get(phone) in contacts
+	}
+
+
+def get_contact_names(phones: list):
+	if not phones:
+		return {}
+
+	cache = frappe.cache()
+	key = cache.make_key(CONTACT_PHONE_INDEX_KEY)
+	pipe = cache.pipeline()
+	pipe.hexists(key, INDEX_BUILT_FIELD)
+	pipe.hmget(key, phones)
+	built, names = pipe.execute()
+	if not built:
+		# Index is built by a background job, till then numbers are looked up as they are stored.
+		if cache.set(cache.make_key(INDEX_BUILD_QUEUED_KEY), 1, nx=True, ex=10 * 60):
+			frappe.enqueue('twilio_integration.twilio_integration.contact_index.build_contact_phone_index',
+				queue='long')
+		return get_contact_names_from_db(phones)
+
+	return {phone: frappe.safe_decode(name) for phone, name in zip(phones, names) if name}
+
+
+def get_contact_names_from_db(phones: list):
+	contact_names = {}
+	for row in frappe.get_all('Contact Phone',
+			filters={'parenttype': 'Contact', 'phone': ['in', phones]},
+			fields=['parent', 'phone'],
+			order_by='is_primary_phone asc, is_primary_mobile_no asc, creation asc'):
+		contact_names[row.phone] = row.parent
+	return contact_names
+
+
+def build_contact_phone_index(batch_size: int=10000):
+	"""(Re)build the phone number index from all the contact phones.
+	"""
+	index = {}
+	# Primary numbers are indexed last, so they win when the number is shared by contacts.
+	for row in frappe.get_all('Contact Phone',
+			filters={'parenttype': 'Contact'},
+			fields=['parent', 'phone'],
+			order_by='is_primary_phone asc, is_primary_mobile_no asc, creation asc'):
+		phone = normalize_phone_number(row.phone)
+		if phone:
+			index[phone] = row.parent
+
+	cache = frappe.cache()
+	key = cache.make_key(CONTACT_PHONE_INDEX_KEY)
+	pipe = cache.pipeline()
+	pipe.delete(key)
+	items = list(index.items())
+	for i in range(0, len(items), batch_size):
+		pipe.hset(key, mapping=dict(items[i:i + batch_size]))
+	pipe.hset(key, INDEX_BUILT_FIELD, 1)
+	pipe.delete(cache.make_key(INDEX_BUILD_QUEUED_KEY))
+	pipe.execute()
+
+
+def update_contact_phone_index(doc, method=None):
+	"""Keep the phone number index in sync with contact phones (Contact `on_update` and `on_trash`).
+	"""
+	old_doc = doc.get_doc_before_save() if method == 'on_update' else doc
+	removed = {normalize_phone_number(row.phone) for row in (old_doc.phone_nos if old_doc else [])}
+	added = {} if method == 'on_trash' else {
+		normalize_phone_number(row.phone): doc.name for row in doc.phone_nos
+	}
+	added.pop(None, None)
+	added.pop('', None)
+	removed = [phone for phone in removed - set(added) if phone]
+
+	cache = frappe.cache()
+	key = cache.make_key(CONTACT_PHONE_INDEX_KEY)
+	if removed:
+		cache.eval(REMOVE_CONTACT_PHONES_SCRIPT, 1, key, doc.name, *removed)
+	if added:
+		# Raw redis call, `RedisWrapper.hset` takes a single field.
+		cache.pipeline().hset(key, mapping=added).execute()
+
+
+def rename_contact_phone_index(doc, method=None, old=None, new=None, merge=False):
+	"""Map the numbers of a renamed (or merged) contact to its new name (Contact `after_rename`).
+	"""
+	phones = {normalize_phone_number(row.phone) for row in doc.phone_nos}
+	phones.discard(None)
+	if not phones:
+		return
+
+	cache = frappe.cache()
+	cache.eval(RENAME_CONTACT_PHONES_SCRIPT, 1, cache.make_key(CONTACT_PHONE_INDEX_KEY),
+		old, new or doc.name, *phones)
@@ -13,34 +13,46 @@ import re
 from json import loads, dumps
 from random import randrange
 
-from twilio.rest import Client
-from ...utils import get_public_url
+from ...twilio_handler import Twilio
+from ...utils import get_public_url, clear_twilio_settings_cache
 
 class TwilioSettings(Document):
 	friendly_resource_name = "ERPNext" # System creates TwiML app & API keys with this name.
 
 	def validate(self):
 		self.validate_twilio_account()
+		self.validate_voice_token_ttl()
 
 	def on_update(self):
+		# Other processes may reload the settings before this transaction is committed,
+		# so the cached settings are dropped once again after the commit.
+		clear_twilio_settings_cache()
+		frappe.enqueue('twilio_integration.twilio_integration.utils.clear_twilio_settings_cache',
+			queue='short', enqueue_after_commit=True)
+
 		# Single doctype records are created in DB at time of installation and those field values are set as null.
 		# This condition make sure that we handle null.
 		if not self.account_sid:
 			return
 
-		twilio = Client(self.account_sid, self.get_password("auth_token"))
+		twilio = Twilio.make_client(self.account_sid, self.get_password("auth_token"))
 		self.set_api_credentials(twilio)
 		self.set_application_credentials(twilio)
 		self.reload()
 
 	def validate_twilio_account(self):
 		try:
-			twilio = Client(self.account_sid, self.get_password("auth_token"))
+			twilio = Twilio.make_client(self.account_sid, self.get_password("auth_token"))
 			twilio.api.accounts(self.account_sid).fetch()
 			return twilio
 		except Exception:
 			frappe.throw(_("Invalid Account SID or Auth Token."))
 
+	def validate_voice_token_ttl(self):
+		# Tokens are refreshed 5 minutes before they expire and twilio allows at most 24 hours.
+		if self.voice_token_ttl and not (600 <= self.voice_token_ttl <= 86400):
+			frappe.throw(_("Voice Token TTL must be between 600 and 86400 seconds."))
+
 	def set_api_credentials(self, twilio):
 		"""Generate Twilio API credentials if not exist and update them.
 		"""
@@ -1,8 +1,71 @@
 # Copyright (c) 2021, Frappe and Contributors
 # See license.txt
 
-# import frappe
 import unittest
+from unittest.mock import patch, MagicMock
+
+import frappe
+from twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message import WhatsAppMessage
+from twilio_integration.twilio_integration.doctype.whatsapp_campaign.whatsapp_campaign import WhatsAppCampaign, \
+	send_campaign_chunk
+
+MODULE = 'twilio_integration.twilio_integration.doctype.whatsapp_campaign.whatsapp_campaign'
 
 class TestWhatsAppCampaign(unittest.TestCase):
-	pass
+	def send_chunk(self, recipients, send, after=None, resume=False, messages=None):
+		db = MagicMock()
+		db.get_value.return_value = frappe._dict(name='Campaign 1', status='In Progress', audience_type='Recipients')
+		settings = frappe._dict(chunk_size=len(recipients), max_workers=1, messages_per_second=None)
+		with patch.object(frappe, 'db', db), \
+			patch.object(frappe, 'log_error'), \
+			patch.object(frappe, 'get_all', return_value=[frappe._dict(m) for m in messages or []]), \
+			patch(MODULE + '.get_campaign_send_settings', return_value=settings), \
+			patch(MODULE + '.get_recipient_page', return_value=(recipients, 'cursor')), \
+			patch(MODULE + '.render_campaign_messages', return_value='Hello'), \
+			patch(MODULE + '.update_campaign_progress') as update_progress, \
+			patch(MODULE + '.enqueue_campaign_chunk') as enqueue, \
+			patch.object(WhatsAppMessage, 'send_whatsapp_message', side_effect=send):
+			send_campaign_chunk('Campaign 1', after=after, resume=resume)
+		return db, update_progress, enqueue
+
+	def test_failed_chunk_saves_its_cursor(self):
+		recipients = [frappe._dict(doctype='Contact', name='c1', whatsapp_no='+14155238886')]
+		db, update_progress, enqueue = self.send_chunk(recipients, Exception('Twilio is down'), after='10')
+
+		db.rollback.assert_called_once()
+		db.set_value.assert_called_with('WhatsApp Campaign', 'Campaign 1', {'status': 'Failed', 'resume_after': '10'})
+		enqueue.assert_not_called()
+
+	def test_resume_starts_from_failed_chunk(self):
+		campaign = frappe._dict(name='Campaign 1', status='Failed', resume_after='10', get_attachment=lambda: None)
+		campaign.db_set = campaign.update
+		with patch(MODULE + '.enqueue_campaign_chunk') as enqueue:
+			WhatsAppCampaign.start_sending(campaign, resume=True)
+
+		enqueue.assert_called_once_with('Campaign 1', after='10', media=None, resume=True)
+		self.assertEqual(campaign.status, 'In Progress')
+
+	def test_resumed_chunk_skips_sent_recipients(self):
+		recipients = [
+			frappe._dict(doctype='Contact', name='c1', whatsapp_no='+14155238801'),
+			frappe._dict(doctype='Contact', name='c2', whatsapp_no='+14155238802'),
+			frappe._dict(doctype='Contact', name='c3', whatsapp_no='+14155238803'),
+			frappe._dict(doctype='Contact', name='c4', whatsapp_no=None)
+		]
+		sent_to = []
+
+		def send(receiver_list, on_write_back, **kwargs):
+			sent_to.extend(receiver_list)
+			on_write_back(len(receiver_list), 0, True)
+			return len(receiver_list), 0
+
+		db, update_progress, enqueue = self.send_chunk(recipients, send, after='10', resume=True, messages=[
+			{'name': 'm1', 'to': 'whatsapp:+14155238801', 'status': 'Delivered'},
+			{'name': 'm2', 'to': 'whatsapp:+14155238802', 'status': None}
+		])
+
+		self.assertEqual(sent_to, ['+14155238802', '+14155238803'])
+		db.delete.assert_called_once_with('WhatsApp Message', {'name': ['in', ['m2']]})
+		# Recipient without a country code is counted as failed once, with the last batch.
+		update_progress.assert_called_once_with('Campaign 1', 2, 1)
+		enqueue.assert_called_once_with('Campaign 1', after='cursor', media=None)
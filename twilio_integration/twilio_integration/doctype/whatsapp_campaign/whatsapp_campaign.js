@@ -3,31 +3,58 @@
 
 frappe.ui.form.on('WhatsApp Campaign', {
 	setup: function(frm) {
+		frm.set_query('audience_filter', function(doc) {
+			return {
+				filters: {
+					reference_doctype: doc.audience_doctype
+				}
+			};
+		});
+	},
+
+	onload: function(frm) {
+		const doctype_list = frm.doc.__onload && frm.doc.__onload.doctype_list;
+		if (doctype_list) {
+			frm.events.set_doctype_options(frm, doctype_list);
+			return;
+		}
+
 		frappe.call({
 			doc: frm.doc,
 			method: 'get_doctype_list',
 			callback: function(r) {
 				if(r.message) {
-					let options = []
-					r.message.forEach((dt) => {
-						options.push({
-							'label': dt,
-							'value': dt
-						});
-					})
-					frappe.meta.get_docfield('WhatsApp Campaign Recipient', 'campaign_for', frm.doc.name).options = [""].concat(options);
+					frm.events.set_doctype_options(frm, r.message);
 				}
 			}
 		});
 	},
 
+	set_doctype_options: function(frm, doctype_list) {
+		let options = doctype_list.map((dt) => {
+			return {
+				'label': dt,
+				'value': dt
+			};
+		});
+		frappe.meta.get_docfield('WhatsApp Campaign Recipient', 'campaign_for', frm.doc.name).options = [""].concat(options);
+		frm.set_df_property('audience_doctype', 'options', [""].concat(options));
+	},
+
+	audience_doctype: function(frm) {
+		frm.set_value('audience_filter', '');
+	},
+
 	refresh: function(frm) {
 		if(frm.doc.status == 'Completed') {
 			frm.disable_form();
 			frm.disable_save();
 		}
-		if(!frm.is_new() && frm.doc.status!='Completed') {
-			frm.add_custom_button(('Send Now'), function(){
+		if(frm.doc.status == 'In Progress') {
+			frm.events.show_progress(frm);
+		}
+		if(!frm.is_new() && !['Completed', 'In Progress'].includes(frm.doc.status)) {
+			frm.add_custom_button(frm.doc.status == 'Failed' ? __('Resume') : __('Send Now'), function(){
 				frappe.call({
 					doc: frm.doc,
 					method: 'send_now',
@@ -38,5 +65,12 @@ frappe.ui.form.on('WhatsApp Campaign', {
 				})
 			});
 		}
+	},
+
+	show_progress: function(frm) {
+		const done = (frm.doc.total_sent || 0) + (frm.doc.total_failed || 0);
+		const total = frm.doc.total_participants || 1;
+		frm.dashboard.show_progress(__('Sending'), done * 100 / total,
+			__('{0} of {1} messages processed', [done, frm.doc.total_participants]));
 	}
 });
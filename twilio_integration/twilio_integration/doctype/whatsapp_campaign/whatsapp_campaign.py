@@ -2,51 +2,60 @@
 # For license information, please see license.txt
 
 import frappe
+from frappe import _
 from frappe.model.document import Document
-from frappe.utils import get_site_url
 from twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message import WhatsAppMessage
+from twilio_integration.twilio_integration.utils import normalize_phone_number, get_twilio_settings
+from twilio_integration.twilio_integration.message_template import get_compiled_template
+from twilio_integration.twilio_integration.media import get_attachment, get_media_url, validate_media
 
-supported_file_ext = ['jpg', 
-	'jpeg',
-	'png',
-	'mp3',
-	'ogg',
-	'amr',
-	'pdf',
-	'mp4'
-]
+WHATSAPP_DOCTYPES_CACHE_KEY = 'twilio_whatsapp_doctypes'
 
 class WhatsAppCampaign(Document):
 	def validate(self):
-		if self.scheduled_time and self.status != 'Completed':
-			current_time = frappe.utils.now_datetime()
-			scheduled_time = frappe.utils.get_datetime(self.scheduled_time)
+		self.set_schedule_status()
 
-			if scheduled_time < current_time:
-				frappe.throw(_("Scheduled Time must be a future time."))
+		if self.audience_type == 'Audience Query':
+			self.validate_audience()
+		else:
+			self.all_missing_recipients()
 
-			self.status = 'Scheduled'
+	def set_schedule_status(self):
+		# Campaigns that are being sent, are sent or have failed are not scheduled again.
+		if self.status in ('In Progress', 'Completed', 'Failed'):
+			return
+
+		if not self.scheduled_time:
+			if self.status == 'Scheduled':
+				self.status = ''
+			return
+
+		if self.has_value_changed('scheduled_time') and \
+			frappe.utils.get_datetime(self.scheduled_time) < frappe.utils.now_datetime():
+			frappe.throw(_("Scheduled Time must be a future time."))
+
+		self.status = 'Scheduled'
+
+	def validate_audience(self):
+		if self.audience_doctype not in self.get_doctype_list():
+			frappe.throw(_('{0} does not have a WhatsApp number field.').format(frappe.bold(self.audience_doctype)))
+
+		if self.audience_filter and \
+			frappe.db.get_value('List Filter', self.audience_filter, 'reference_doctype') != self.audience_doctype:
+			frappe.throw(_('Audience Filter must belong to {0}.').format(frappe.bold(self.audience_doctype)))
+
+	def get_audience_filters(self):
+		if not self.audience_filter:
+			return []
+		return frappe.parse_json(frappe.db.get_value('List Filter', self.audience_filter, 'filters') or '[]')
 
-		self.all_missing_recipients()
-	
 	def validate_attachment(self):
 		attachment = self.get_attachment()
 		if attachment:
-			if attachment.file_size > 16777216:
-				frappe.throw(_('Attachment size must be less than 16MB.'))
-
-			if attachment.is_private:
-				frappe.throw(_('Attachment must be public.'))
-
-			if attachment.get_extension() not in supported_file_ext:
-				frappe.throw(_('Attachment format not supported.'))
+			validate_media(attachment)
 
 	def get_attachment(self):
-		file = frappe.db.get_value("File", {"attached_to_name": self.doctype, "attached_to_doctype": self.name, "is_private":0}, 'name')
-
-		if file:
-			return frappe.get_doc('File', file)
-		return None
+		return get_attachment(self.doctype, self.name)
 
 	def get_whatsapp_contact(self):
 		contacts = [recipient.whatsapp_no for recipient in self.recipients if recipient.whatsapp_no]
@@ -54,40 +63,346 @@ class WhatsAppCampaign(Document):
 		return contacts
 	
 	def all_missing_recipients(self):
+		"""Fill missing whatsapp numbers of recipients, normalize them and remove duplicate recipients.
+		Numbers without a country code are kept as they are, and counted as failed when the campaign is sent.
+		"""
+		missing = {}
 		for recipient in self.recipients:
 			if not recipient.whatsapp_no:
-				recipient.whatsapp_no = frappe.db.get_value(recipient.campaign_for, recipient.recipient, 'whatsapp_no')
-		
+				missing.setdefault(recipient.campaign_for, set()).add(recipient.recipient)
+
+		numbers = {}
+		for doctype, names in missing.items():
+			for name, whatsapp_no in get_whatsapp_numbers(doctype, list(names)):
+				numbers[(doctype, name)] = whatsapp_no
+
+		seen, recipients, invalid = set(), [], []
+		for recipient in self.recipients:
+			whatsapp_no = recipient.whatsapp_no or numbers.get((recipient.campaign_for, recipient.recipient))
+			normalized = normalize_phone_number(whatsapp_no)
+			if normalized in seen:
+				continue
+			if normalized:
+				seen.add(normalized)
+			elif whatsapp_no:
+				invalid.append(whatsapp_no)
+			recipient.whatsapp_no = normalized or whatsapp_no
+			recipients.append(recipient)
+
+		if invalid:
+			frappe.msgprint(_('Messages will not be sent to numbers without a country code: {0}').format(
+				', '.join(invalid)), alert=True)
+
+		if len(recipients) != len(self.recipients):
+			for idx, recipient in enumerate(recipients, 1):
+				recipient.idx = idx
+			self.set('recipients', recipients)
+
 		self.total_participants = len(self.recipients)
 
+	def onload(self):
+		self.set_onload('doctype_list', self.get_doctype_list())
+
 	@frappe.whitelist()
 	def get_doctype_list(self):
-		standard_doctype = frappe.db.sql_list("""SELECT dt.parent FROM `tabDocField` 
-			df INNER JOIN `tabDoctype` dt ON dt.name = dt.parent
-			WHERE df.fieldname='whatsapp_no' AND dt.istable = 0 AND dt.issingle = 0 AND dt.is_tree = 0""")
-		
-		custom_doctype = frappe.db.sql_list("""SELECT dt FROM `tabCustom Field`
-			cf INNER JOIN `tabDoctype` dt ON dt.name = cf.dt
-			WHERE cf.fieldname='whatsapp_no' AND dt.istable = 0 AND dt.issingle = 0 AND dt.is_tree = 0""")
-
-		return standard_doctype + custom_doctype
+		return list(get_whatsapp_doctypes())
 
 	@frappe.whitelist()
 	def send_now(self):
+		"""Queue the campaign to be sent in chunks by background jobs, a failed campaign is resumed.
+		"""
 		self.validate_attachment()
-		media = self.get_attachment()
-		self.db_set('status', 'In Progress')
-		if media:
-			media = get_site_url(frappe.local.site) + media.file_url
+		resume = self.status == 'Failed'
+		if not self.claim():
+			frappe.throw(_('Campaign is already being sent or has been sent.'))
+		self.start_sending(resume=resume)
+
+	def claim(self, statuses=('', 'Scheduled', 'Failed')):
+		"""Move the campaign to `In Progress` if it is in one of the given statuses (draft, scheduled
+		or failed by default). The campaign row is locked till the transaction ends, so it is claimed once.
+		Returns False if the campaign is being sent or has been sent, e.g. claimed by another worker.
+		"""
+		status = frappe.db.get_value('WhatsApp Campaign', self.name, 'status', for_update=True)
+		if (status or '') not in statuses:
+			return False
+
+		frappe.db.set_value('WhatsApp Campaign', self.name, 'status', 'In Progress', update_modified=False)
+		return True
+
+	def start_sending(self, resume=False):
+		"""Reset the progress of a claimed campaign and queue its first chunk.
+		A failed campaign is resumed from the chunk that failed, keeping its progress.
+		"""
+		attachment = self.get_attachment()
+		media = attachment and get_media_url(attachment)
+
+		if resume:
+			after = self.resume_after or None
+			self.db_set({'status': 'In Progress', 'resume_after': None})
+			enqueue_campaign_chunk(self.name, after=after, media=media, resume=True)
+			return
+
+		if self.audience_type == 'Audience Query':
+			fieldname = get_whatsapp_field(self.audience_doctype)
+			self.total_participants = frappe.get_all(self.audience_doctype,
+				filters=self.get_audience_filters() + [[self.audience_doctype, fieldname, 'is', 'set']],
+				fields=['count(*) as count']
+			)[0].count
+
+		self.db_set({
+			'status': 'In Progress',
+			'send_on': frappe.utils.now_datetime(),
+			'total_participants': self.total_participants,
+			'total_sent': 0,
+			'total_failed': 0,
+			'completed_on': None,
+			'resume_after': None
+		})
+		enqueue_campaign_chunk(self.name, media=media)
+
+def get_whatsapp_doctypes():
+	"""Get doctypes that can be targeted by campaigns along with their whatsapp number field.
+	>>> get_whatsapp_doctypes()
+	{'Customer': 'whatsapp_no', 'Lead': 'whatsapp_no'}
+
+	Registry is cached till a DocType or Custom Field is changed.
+	"""
+	return frappe.cache().get_value(WHATSAPP_DOCTYPES_CACHE_KEY, generator=build_whatsapp_doctypes)
+
+def build_whatsapp_doctypes():
+	candidates = frappe.db.sql_list("""
+		SELECT `parent` FROM `tabDocField` WHERE `fieldname` = 'whatsapp_no' AND `parenttype` = 'DocType'
+		UNION
+		SELECT `dt` FROM `tabCustom Field` WHERE `fieldname` = 'whatsapp_no'
+	""")
+
+	doctypes = {}
+	for doctype in sorted(candidates):
+		if not frappe.db.exists('DocType', doctype):
+			continue
+		meta = frappe.get_meta(doctype)
+		if meta.istable or meta.issingle or meta.is_tree or not meta.has_field('whatsapp_no'):
+			continue
+		doctypes[doctype] = 'whatsapp_no'
+	return doctypes
+
+def clear_whatsapp_doctypes_cache(doc=None, method=None):
+	# Other processes may cache the old doctypes again before this transaction is committed,
+	# so the cache is dropped once again after the commit.
+	drop_whatsapp_doctypes_cache()
+	frappe.enqueue(
+		'twilio_integration.twilio_integration.doctype.whatsapp_campaign.whatsapp_campaign.drop_whatsapp_doctypes_cache',
+		queue='short', enqueue_after_commit=True)
+
+def drop_whatsapp_doctypes_cache():
+	frappe.cache().delete_value(WHATSAPP_DOCTYPES_CACHE_KEY)
+
+def get_whatsapp_field(doctype):
+	return get_whatsapp_doctypes().get(doctype) or 'whatsapp_no'
+
+def get_whatsapp_numbers(doctype, names, chunk_size=1000):
+	"""Yield (name, whatsapp number) of the given records, fetched with one query per chunk of names.
+	"""
+	fieldname = get_whatsapp_field(doctype)
+	for i in range(0, len(names), chunk_size):
+		yield from frappe.get_all(doctype,
+			filters={'name': ['in', names[i:i + chunk_size]]},
+			fields=['name', fieldname],
+			as_list=True
+		)
+
+def get_campaign_send_settings():
+	settings = get_twilio_settings()
+	return frappe._dict({
+		'chunk_size': settings.campaign_chunk_size or 500,
+		'max_workers': settings.max_send_threads or 1,
+		'messages_per_second': settings.messages_per_second,
+		'campaigns_per_run': settings.campaigns_per_run or 5
+	})
+
+def send_scheduled_campaigns():
+	"""Start the scheduled campaigns that are due, runs every minute.
+
+	Campaigns are claimed one by one with a locking read, so that a campaign is started only once
+	even when the scheduler runs on several benches. Only a few campaigns are started per run, the rest
+	are picked up by the following runs instead of flooding the long queue at once.
+	"""
+	due = frappe.get_all('WhatsApp Campaign',
+		filters={'status': 'Scheduled', 'scheduled_time': ['<=', frappe.utils.now_datetime()]},
+		order_by='scheduled_time asc',
+		limit_page_length=get_campaign_send_settings().campaigns_per_run,
+		pluck='name'
+	)
+	for name in due:
+		campaign = frappe.get_doc('WhatsApp Campaign', name)
+		try:
+			if campaign.claim(['Scheduled']):
+				campaign.start_sending()
+			frappe.db.commit()
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(title=_('Failed to start WhatsApp Campaign {0}').format(name))
+
+def get_recipient_page(campaign, after=None, page_size=500):
+	"""Get a page of campaign recipients and the cursor to fetch the next page.
+	WhatsApp numbers are normalized, it is None for the numbers without a country code.
+
+	Recipients are either the rows of the campaign or the records matched by the audience query.
+	Pages are fetched with keyset pagination (`idx` or `name` after the cursor), so the cost of
+	a page doesn't grow with the size of the audience.
+	"""
+	if campaign.audience_type == 'Audience Query':
+		doctype = campaign.audience_doctype
+		fieldname = get_whatsapp_field(doctype)
+		filters = frappe.parse_json(campaign.audience_filters or '[]') + [
+			[doctype, fieldname, 'is', 'set'],
+			[doctype, 'name', '>', after or '']
+		]
+		rows = frappe.get_all(doctype,
+			filters=filters,
+			fields=['name', '{0} as whatsapp_no'.format(fieldname)],
+			order_by='name asc',
+			limit_page_length=page_size
+		)
+		recipients = [frappe._dict(doctype=doctype, name=row.name, whatsapp_no=row.whatsapp_no) for row in rows]
+		cursor = rows and rows[-1].name
+	else:
+		rows = frappe.get_all('WhatsApp Campaign Recipient',
+			filters={
+				'parenttype': 'WhatsApp Campaign',
+				'parent': campaign.name,
+				'whatsapp_no': ['is', 'set'],
+				'idx': ['>', after or 0]
+			},
+			fields=['idx', 'campaign_for', 'recipient', 'whatsapp_no'],
+			order_by='idx asc',
+			limit_page_length=page_size
+		)
+		recipients = [frappe._dict(doctype=row.campaign_for, name=row.recipient, whatsapp_no=row.whatsapp_no) for row in rows]
+		cursor = rows and rows[-1].idx
+
+	for recipient in recipients:
+		recipient.whatsapp_no = normalize_phone_number(recipient.whatsapp_no)
+	return recipients, cursor
+
+def enqueue_campaign_chunk(campaign, after=None, media=None, resume=False):
+	frappe.enqueue(
+		'twilio_integration.twilio_integration.doctype.whatsapp_campaign.whatsapp_campaign.send_campaign_chunk',
+		queue='long',
+		enqueue_after_commit=True,
+		campaign=campaign,
+		after=after,
+		media=media,
+		resume=resume
+	)
+
+def send_campaign_chunk(campaign, after=None, media=None, resume=False):
+	"""Send one chunk of campaign recipients and queue the next one.
+
+	Chunks are sent one after another, so that the configured messages per second
+	are respected no matter how many workers are running. Progress is updated in the same
+	transaction as the results of every batch of sent messages, and the next chunk is queued
+	with the last batch. When a chunk fails the campaign is marked `Failed` with the cursor
+	of the chunk, and `Send Now` resumes it from there (recipients of the resumed chunk that
+	were already sent a message are skipped).
+	"""
+	campaign = frappe.db.get_value('WhatsApp Campaign', campaign,
+		['name', 'status', 'message', 'audience_type', 'audience_doctype', 'audience_filter', 'modified'], as_dict=True)
+	if campaign.status != 'In Progress':
+		return
+
+	try:
+		if campaign.audience_filter:
+			campaign.audience_filters = frappe.db.get_value('List Filter', campaign.audience_filter, 'filters')
+
+		settings = get_campaign_send_settings()
+		recipients, cursor = get_recipient_page(campaign, after, settings.chunk_size)
+		is_last_chunk = len(recipients) < settings.chunk_size
+
+		# Numbers without a country code can't be sent to.
+		invalid = [recipient for recipient in recipients if not recipient.whatsapp_no]
+		recipients = [recipient for recipient in recipients if recipient.whatsapp_no]
+		if resume:
+			recipients = get_unsent_recipients(campaign.name, recipients)
+
+		def on_write_back(sent, failed, done):
+			update_campaign_progress(campaign.name, sent, failed + (len(invalid) if done else 0))
+			if not done:
+				return
+			if is_last_chunk:
+				frappe.db.set_value('WhatsApp Campaign', campaign.name, {
+					'status': 'Completed',
+					'completed_on': frappe.utils.now_datetime()
+				})
+			else:
+				enqueue_campaign_chunk(campaign.name, after=cursor, media=media)
 
 		WhatsAppMessage.send_whatsapp_message(
-			receiver_list = self.get_whatsapp_contact(),
-			message = self.message,
-			doctype = self.doctype,
-			docname = self.name,
-			media = media
+			receiver_list = [recipient.whatsapp_no for recipient in recipients],
+			message = render_campaign_messages(campaign, recipients),
+			doctype = 'WhatsApp Campaign',
+			docname = campaign.name,
+			media = media,
+			max_workers = settings.max_workers,
+			messages_per_second = settings.messages_per_second,
+			commit = True,
+			on_write_back = on_write_back
 		)
+	except Exception:
+		frappe.db.rollback()
+		frappe.log_error(title=_('Failed to send WhatsApp Campaign {0}').format(campaign.name))
+		frappe.db.set_value('WhatsApp Campaign', campaign.name, {'status': 'Failed', 'resume_after': after})
+		frappe.db.commit()
+
+def get_unsent_recipients(campaign, recipients):
+	"""Recipients that were not sent a message of the campaign yet.
+	Messages of the failed chunk that were stored but never sent (no status) are deleted, they are sent again.
+	"""
+	if not recipients:
+		return recipients
+
+	sent_to, unsent = set(), []
+	for message in frappe.get_all('WhatsApp Message',
+			filters={
+				'reference_doctype': 'WhatsApp Campaign',
+				'reference_document_name': campaign,
+				'to': ['in', ['whatsapp:{0}'.format(recipient.whatsapp_no) for recipient in recipients]]
+			},
+			fields=['name', 'to', 'status']):
+		if message.status:
+			sent_to.add(message.to)
+		else:
+			unsent.append(message.name)
+
+	if unsent:
+		frappe.db.delete('WhatsApp Message', {'name': ['in', unsent]})
+	return [recipient for recipient in recipients if 'whatsapp:{0}'.format(recipient.whatsapp_no) not in sent_to]
+
+def on_doctype_update():
+	frappe.db.add_index("WhatsApp Campaign", ["status", "scheduled_time"])
+
+def render_campaign_messages(campaign, recipients):
+	"""Render the campaign message for a page of recipients, the record of the recipient is available as `doc`.
+	Template is compiled once and records are fetched with one query per doctype. Messages that don't use
+	`doc` are rendered only once.
+	"""
+	template = get_compiled_template(('WhatsApp Campaign', campaign.name), campaign.message, campaign.modified)
+	if not template.uses('doc'):
+		return template.render()
+
+	names = {}
+	for recipient in recipients:
+		names.setdefault(recipient.doctype, []).append(recipient.name)
 
-		self.db_set('status', 'Completed')
+	docs = {}
+	for doctype, doc_names in names.items():
+		for doc in frappe.get_all(doctype, filters={'name': ['in', doc_names]}, fields=['*']):
+			docs[(doctype, doc.name)] = doc
 
+	return template.render_for_docs(
+		docs.get((recipient.doctype, recipient.name), frappe._dict()) for recipient in recipients)
 
+def update_campaign_progress(campaign, sent, failed):
+	frappe.db.sql("""UPDATE `tabWhatsApp Campaign`
+		SET total_sent = total_sent + %(sent)s, total_failed = total_failed + %(failed)s
+		WHERE name = %(campaign)s""", {'sent': sent, 'failed': failed, 'campaign': campaign})
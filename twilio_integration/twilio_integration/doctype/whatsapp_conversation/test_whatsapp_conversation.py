@@ -0,0 +1,44 @@
+# Copyright (c) 2021, Frappe and Contributors
+# See license.txt
+
+import operator
+import unittest
+from unittest.mock import patch
+
+import frappe
+from twilio_integration.twilio_integration.doctype.whatsapp_conversation.whatsapp_conversation import get_conversations
+
+OPERATORS = {'>': operator.gt, '>=': operator.ge}
+
+def get_list(rows):
+	"""Stand-in for `frappe.get_list` over in memory rows, for the filters used by `get_conversations`.
+	"""
+	def _get_list(doctype, filters=None, or_filters=None, fields=None, order_by=None, limit_page_length=None):
+		def matches(row, conditions):
+			return [OPERATORS[op](row[field], value) for field, (op, value) in conditions.items()]
+
+		result = [row for row in rows
+			if all(matches(row, filters or {})) and (not or_filters or any(matches(row, or_filters)))]
+		keys = [part.split()[0] for part in order_by.split(',')]
+		result.sort(key=lambda row: [row[key] for key in keys])
+		return result[:limit_page_length]
+	return _get_list
+
+class TestWhatsAppConversation(unittest.TestCase):
+	def test_incremental_fetch_with_same_modified(self):
+		# A campaign chunk updates many conversations with a single `modified`.
+		rows = [frappe._dict(name='conv{0:02d}'.format(i), modified='2021-08-30 10:00:01') for i in range(45)]
+		rows += [frappe._dict(name='aconv', modified='2021-08-30 10:00:02')]
+
+		fetched, modified_after, after = [], '2021-08-30 10:00:00', None
+		with patch.object(frappe, 'get_list', side_effect=get_list(rows)):
+			while True:
+				page = get_conversations(modified_after, limit=20, after=after)
+				if not page:
+					break
+				fetched.extend(row.name for row in page)
+				modified_after, after = page[-1].modified, page[-1].name
+
+		self.assertEqual(len(fetched), len(rows))
+		self.assertEqual(set(fetched), {row.name for row in rows})
+		self.assertEqual(fetched[-1], 'aconv')
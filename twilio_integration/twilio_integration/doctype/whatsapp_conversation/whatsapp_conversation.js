@@ -0,0 +1,8 @@
+// Copyright (c) 2021, Frappe and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('WhatsApp Conversation', {
+	// refresh: function(frm) {
+
+	// }
+});
@@ -0,0 +1,147 @@
+# Copyright (c) 2021, Frappe and contributors
+# For license information, please see license.txt
+
+import hashlib
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+from frappe.utils import cint
+from ...utils import bulk_update_values, normalize_phone_number
+
+class WhatsAppConversation(Document):
+	pass
+
+def get_conversation_name(business_number, customer_number):
+	"""Conversation names are derived from the pair of numbers, so that messages can be linked without a lookup.
+	The full digest is used, conversations are inserted ignoring duplicates so a collision would merge threads.
+	"""
+	return hashlib.sha1('{0}|{1}'.format(business_number, customer_number).encode()).hexdigest()
+
+def get_conversation_numbers(message):
+	"""Business and customer numbers of a message as normalized `whatsapp:` addresses.
+	"""
+	if message.get('sent_received') == 'Received':
+		numbers = message.get('to'), message.get('from_')
+	else:
+		numbers = message.get('from_'), message.get('to')
+	return tuple(normalize_whatsapp_address(number) for number in numbers)
+
+def normalize_whatsapp_address(address):
+	"""
+	>>> normalize_whatsapp_address('whatsapp:+91 98765 43210')
+	'whatsapp:+919876543210'
+	"""
+	number = normalize_phone_number(address)
+	return 'whatsapp:' + number if number else address
+
+def set_conversation(messages):
+	for message in messages:
+		message.conversation = get_conversation_name(*get_conversation_numbers(message))
+
+def update_conversations(messages):
+	"""Create the missing conversations of the messages and move their last message and unread count,
+	with a few batched queries. Messages are expected in the order they were sent or received.
+	"""
+	now, user = frappe.utils.now(), frappe.session.user
+	conversations = {}
+	for message in messages:
+		business_number, customer_number = get_conversation_numbers(message)
+		conversation = conversations.setdefault(message.conversation, frappe._dict(
+			name=message.conversation,
+			business_number=business_number,
+			customer_number=customer_number,
+			unread=0,
+			values={}
+		))
+		conversation.values.update({
+			'last_message': message.name,
+			'last_message_text': (message.get('message') or '')[:140],
+			'last_message_on': message.get('send_on') or message.get('creation') or now,
+			'last_sent_received': 'Received' if message.get('sent_received') == 'Received' else 'Sent'
+		})
+		if message.get('sent_received') == 'Received':
+			conversation.unread += 1
+			if message.get('profile_name'):
+				conversation.values['profile_name'] = message.profile_name
+
+	if not conversations:
+		return
+
+	frappe.db.bulk_insert('WhatsApp Conversation',
+		fields=['name', 'business_number', 'customer_number', 'unread_count',
+			'creation', 'modified', 'owner', 'modified_by', 'docstatus'],
+		values=[[c.name, c.business_number, c.customer_number, 0, now, now, user, user, 0]
+			for c in conversations.values()],
+		ignore_duplicates=True
+	)
+	bulk_update_values('WhatsApp Conversation', {c.name: c.values for c in conversations.values()})
+
+	# Conversations are grouped by the number of new messages, usually there are only a few groups.
+	unread = {}
+	for conversation in conversations.values():
+		if conversation.unread:
+			unread.setdefault(conversation.unread, []).append(conversation.name)
+	for count, names in unread.items():
+		frappe.db.sql("""UPDATE `tabWhatsApp Conversation` SET `unread_count` = `unread_count` + %(count)s
+			WHERE `name` IN %(names)s""", {'count': count, 'names': names})
+
+@frappe.whitelist()
+def get_conversations(modified_after=None, limit=20, after=None):
+	"""Conversations of the inbox, latest first.
+	To fetch only the changed conversations pass the `modified` and `name` of the last changed conversation
+	already loaded as `modified_after` and `after`. These are returned by `modified` and `name`, so that
+	the fetch can be repeated from the last one returned (many conversations share the same `modified`).
+	"""
+	filters, or_filters = {}, {}
+	if modified_after and after:
+		# (modified, name) > (modified_after, after)
+		filters = {'modified': ['>=', modified_after]}
+		or_filters = {'modified': ['>', modified_after], 'name': ['>', after]}
+	elif modified_after:
+		filters = {'modified': ['>', modified_after]}
+
+	return frappe.get_list('WhatsApp Conversation',
+		filters=filters,
+		or_filters=or_filters,
+		fields=['name', 'business_number', 'customer_number', 'profile_name', 'unread_count',
+			'last_message', 'last_message_text', 'last_message_on', 'last_sent_received', 'modified'],
+		order_by='modified asc, name asc' if modified_after else 'last_message_on desc',
+		limit_page_length=cint(limit)
+	)
+
+@frappe.whitelist()
+def get_conversation_messages(conversation, after=None, before=None, limit=50):
+	"""Messages of a conversation in the order they were sent or received, paged with message names as cursors.
+	`after` fetches messages newer than the given message (to poll for new messages), `before` fetches
+	older ones (to scroll back), without either the latest messages are returned.
+	"""
+	if not frappe.has_permission('WhatsApp Conversation', doc=conversation):
+		frappe.throw(_('Not permitted'), frappe.PermissionError)
+
+	values = {'conversation': conversation, 'limit': cint(limit)}
+	condition = ''
+	cursor = after or before
+	if cursor:
+		operator = '>' if after else '<'
+		values.update(cursor=cursor, creation=frappe.db.get_value('WhatsApp Message', cursor, 'creation'))
+		condition = """AND (`creation` {0} %(creation)s
+			OR (`creation` = %(creation)s AND `name` {0} %(cursor)s))""".format(operator)
+
+	order = 'ASC' if after else 'DESC'
+	messages = frappe.db.sql("""SELECT `name`, `from_`, `to`, `message`, `media_link`, `status`,
+			`sent_received`, `send_on`, `profile_name`, `creation`
+		FROM `tabWhatsApp Message`
+		WHERE `conversation` = %(conversation)s {condition}
+		ORDER BY `creation` {order}, `name` {order}
+		LIMIT %(limit)s""".format(condition=condition, order=order), values, as_dict=True)
+
+	if not after:
+		messages.reverse()
+	return messages
+
+@frappe.whitelist()
+def mark_conversation_as_read(conversation):
+	if not frappe.has_permission('WhatsApp Conversation', 'write', doc=conversation):
+		frappe.throw(_('Not permitted'), frappe.PermissionError)
+	frappe.db.set_value('WhatsApp Conversation', conversation, 'unread_count', 0)
@@ -1,8 +1,50 @@
 # Copyright (c) 2021, Frappe and Contributors
 # See license.txt
 
-# import frappe
 import unittest
+from unittest.mock import patch
+
+import frappe
+from twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message import apply_status_updates
 
 class TestWhatsAppMessage(unittest.TestCase):
-	pass
+	def apply_status_updates(self, events, messages):
+		with patch.object(frappe, 'get_all', return_value=[frappe._dict(m) for m in messages]) as get_all, \
+			patch('twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message.bulk_update_values') as bulk_update:
+			changes, unknown = apply_status_updates(events)
+		return changes, unknown, get_all, bulk_update
+
+	def test_status_collapsed_to_latest(self):
+		changes, unknown, get_all, bulk_update = self.apply_status_updates([
+			{'id': 'SM1', 'status': 'sent'},
+			{'id': 'SM1', 'status': 'read'},
+			{'id': 'SM1', 'status': 'delivered'}
+		], [{'name': 'msg1', 'id': 'SM1', 'status': 'Queued', 'conversation': 'conv1'}])
+
+		self.assertEqual(get_all.call_args.kwargs['filters'], {'id': ['in', ['SM1']]})
+		self.assertEqual(changes, [{'name': 'msg1', 'id': 'SM1', 'status': 'Read', 'conversation': 'conv1'}])
+		self.assertEqual(unknown, [])
+		bulk_update.assert_called_once_with('WhatsApp Message', {'SM1': {'status': 'Read'}}, key_field='id')
+
+	def test_status_never_moves_backwards(self):
+		changes, unknown, get_all, bulk_update = self.apply_status_updates([
+			{'id': 'SM1', 'status': 'delivered'},
+			{'id': 'SM2', 'status': 'read'}
+		], [
+			{'name': 'msg1', 'id': 'SM1', 'status': 'Read', 'conversation': 'conv1'},
+			{'name': 'msg2', 'id': 'SM2', 'status': 'Read', 'conversation': 'conv1'}
+		])
+
+		self.assertEqual(changes, [])
+		bulk_update.assert_called_once_with('WhatsApp Message', {}, key_field='id')
+
+	def test_unknown_messages(self):
+		events = [{'id': 'SM1', 'status': 'sent'}, {'id': 'SM2', 'status': 'sent'}]
+		changes, unknown, get_all, bulk_update = self.apply_status_updates(events,
+			[{'name': 'msg1', 'id': 'SM1', 'status': 'Queued', 'conversation': 'conv1'}])
+
+		self.assertEqual([change['id'] for change in changes], ['SM1'])
+		self.assertEqual(unknown, [{'id': 'SM2', 'status': 'sent'}])
+
+	def test_no_events(self):
+		self.assertEqual(apply_status_updates([]), ([], []))
@@ -1,70 +1,329 @@
 # Copyright (c) 2021, Frappe and contributors
 # For license information, please see license.txt
 
+import time
+from json import loads, dumps
+from concurrent.futures import ThreadPoolExecutor
+
 import frappe
 from frappe.model.document import Document
 from six import string_types
-from frappe.utils.password import get_decrypted_password
 from frappe.utils import get_site_url
 from frappe import _
 from ...twilio_handler import Twilio
+from ...throttle import TokenBucket, is_throttle_error, get_backoff
+from ...utils import bulk_update_values, get_twilio_settings
+from ..whatsapp_conversation.whatsapp_conversation import get_conversation_name, get_conversation_numbers, \
+	set_conversation, update_conversations
+
+# Throttled sends are retried with backoff, after that the message is moved to `Dead Letter`.
+MAX_SEND_ATTEMPTS = 5
+# Results of sent messages are written back after every so many messages.
+WRITE_BACK_BATCH_SIZE = 50
+QUEUED_MESSAGES_CACHE_KEY = 'twilio_queued_whatsapp_messages_'
+QUEUED_MESSAGES_EXPIRY = 24 * 60 * 60
+
+# Twilio can deliver status callbacks out of order, status with a higher rank wins.
+STATUS_RANK = {
+	'Queued': 1,
+	'Sent': 2,
+	'Undelivered': 3,
+	'Failed': 3,
+	'Delivered': 4,
+	'Read': 5
+}
 
 class WhatsAppMessage(Document):
-	def send(self):
-		client = Twilio.get_twilio_client()
-		message_dict = self.get_message_dict()
-		response = frappe._dict()
-
-		try:
-			response = client.messages.create(**message_dict)
-			self.sent_received = 'Sent'
-			self.status = response.status.title()
-			self.id = response.sid
-			self.send_on = response.date_sent
-			self.save(ignore_permissions=True)
-		
-		except Exception as e:
-			self.db_set('status', "Error")
-			frappe.log_error(e, title = _('Twilio WhatsApp Message Error'))
-	
-	def get_message_dict(self):
-		args = {
-			'from_': self.from_,
-			'to': self.to,
-			'body': self.message,
-			'status_callback': '{}/api/method/twilio_integration.twilio_integration.api.whatsapp_message_status_callback'.format(get_site_url(frappe.local.site))
-		}
-		if self.media_link:
-			args['media_url'] = [self.media_link]
-
-		return args
+	def before_insert(self):
+		self.conversation = get_conversation_name(*get_conversation_numbers(self))
+
+	def after_insert(self):
+		update_conversations([self])
+
+	def get_message_dict(self, status_callback=None):
+		return get_message_dict(self, status_callback)
 
 	@classmethod
-	def send_whatsapp_message(self, receiver_list, message, doctype, docname, media=None):
+	def get_by_sid(cls, sid, fields='name'):
+		"""Lookup a message by its twilio message SID (uses the unique index on `id`).
+		>>> WhatsAppMessage.get_by_sid('SM2d1...', ['name', 'status'])
+		{'name': '1c2e4a...', 'status': 'Delivered'}
+		"""
+		if not sid:
+			return
+		return frappe.db.get_value('WhatsApp Message', {'id': sid}, fields, as_dict=True)
+
+	@classmethod
+	def send_whatsapp_message(cls, receiver_list, message, doctype, docname, media=None, max_workers=1,
+			messages_per_second=None, commit=False, on_write_back=None):
+		"""Store and send a WhatsApp message to every receiver, `message` can also be a list of messages
+		(one per receiver). Set `commit` in background jobs to commit sent messages as they go,
+		see `dispatch_messages` for `on_write_back`. Returns the number of messages sent and failed.
+		"""
 		if isinstance(receiver_list, string_types):
 			receiver_list = loads(receiver_list)
 			if not isinstance(receiver_list, list):
 				receiver_list = [receiver_list]
 
-		for rec in receiver_list:
-			message = self.store_whatsapp_message(rec, message, doctype, docname)
-			message.send()
+		messages = store_whatsapp_messages(receiver_list, message, doctype, docname, media)
+		return dispatch_messages(messages, max_workers=max_workers, messages_per_second=messages_per_second,
+			commit=commit, on_write_back=on_write_back)
+
+def get_status_callback_url():
+	return '{}/api/method/twilio_integration.twilio_integration.api.whatsapp_message_status_callback'.format(get_site_url(frappe.local.site))
+
+def get_message_dict(message, status_callback=None):
+	args = {
+		'from_': message.from_,
+		'to': message.to,
+		'body': message.message,
+		'status_callback': status_callback or get_status_callback_url()
+	}
+	if message.media_link:
+		args['media_url'] = [message.media_link]
+
+	return args
+
+def store_whatsapp_messages(receiver_list, message, doctype=None, docname=None, media=None):
+	"""Create `WhatsApp Message` records for all the receivers with a multi-row insert.
+	Returns the stored rows, names are generated upfront so that rows can be updated after sending.
+	"""
+	sender = 'whatsapp:{}'.format(get_twilio_settings().whatsapp_no)
+	now, user = frappe.utils.now(), frappe.session.user
+	if not isinstance(message, list):
+		message = [message] * len(receiver_list)
+
+	messages = [frappe._dict({
+		'name': frappe.generate_hash('WhatsApp Message', 10),
+		'from_': sender,
+		'to': 'whatsapp:{}'.format(to),
+		'message': text,
+		'reference_doctype': doctype,
+		'reference_document_name': docname,
+		'media_link': media
+	}) for to, text in zip(receiver_list, message)]
+	set_conversation(messages)
+
+	if messages:
+		fields = list(messages[0])
+		frappe.db.bulk_insert('WhatsApp Message',
+			fields=fields + ['creation', 'modified', 'owner', 'modified_by', 'docstatus'],
+			values=[[m[f] for f in fields] + [now, now, user, user, 0] for m in messages]
+		)
+		update_conversations(messages)
+	return messages
+
+class ThrottledError(Exception):
+	"""Message is still throttled by twilio after all the attempts.
+	"""
+
+def dispatch_messages(messages, max_workers=1, messages_per_second=None, commit=False, on_write_back=None):
+	"""Send stored WhatsApp messages through twilio using a bounded pool of threads.
+
+	Sends are rate limited per sender number across all workers, and retried with backoff
+	when twilio throttles them. Only twilio API calls run in the worker threads, results are
+	written back from the calling thread with batched updates every `WRITE_BACK_BATCH_SIZE`
+	messages, and committed when `commit` is set so that an interrupted job loses few results.
+	`on_write_back(sent, failed, done)` is called in the transaction of every written back batch,
+	`done` is set for the last one. Returns the number of messages sent and failed.
+	"""
+	client = Twilio.get_twilio_client()
+	if messages_per_second is None:
+		messages_per_second = get_twilio_settings().messages_per_second
+	limiters = {sender: TokenBucket(sender, messages_per_second) for sender in {m.from_ for m in messages}}
+	status_callback = get_status_callback_url()
+	payloads = [get_message_dict(message, status_callback) for message in messages]
+
+	def _send(payload):
+		error = None
+		for attempt in range(MAX_SEND_ATTEMPTS):
+			limiters[payload['from_']].acquire()
+			try:
+				return client.messages.create(**payload), None
+			except Exception as e:
+				error = e
+				if not is_throttle_error(e):
+					return None, e
+				time.sleep(get_backoff(attempt))
+		return None, ThrottledError(error)
+
+	executor = None
+	if max_workers > 1 and len(payloads) > 1:
+		executor = ThreadPoolExecutor(max_workers=max_workers)
+
+	failed = 0
+	updates, errors = {}, []
+	try:
+		results = executor.map(_send, payloads) if executor else map(_send, payloads)
+		for message, (response, error) in zip(messages, results):
+			if error:
+				updates[message.name] = {'status': 'Dead Letter' if isinstance(error, ThrottledError) else 'Error'}
+				errors.append('{0}: {1}'.format(message.to, error))
+			else:
+				updates[message.name] = {
+					'sent_received': 'Sent',
+					'status': response.status.title(),
+					'id': response.sid,
+					'send_on': response.date_sent
+				}
 
-	def store_whatsapp_message(to, message, doctype=None, docname=None, media=None):
-		sender = frappe.db.get_single_value('Twilio Settings', 'whatsapp_no')
-		wa_msg = frappe.get_doc({
-				'doctype': 'WhatsApp Message',
-				'from_': 'whatsapp:{}'.format(sender),
-				'to': 'whatsapp:{}'.format(to),
-				'message': message,
-				'reference_doctype': doctype,
-				'reference_document_name': docname,
-				'media_link': media
-			}).insert(ignore_permissions=True)
+			if len(updates) >= WRITE_BACK_BATCH_SIZE:
+				failed += len(errors)
+				write_back_results(updates, errors, commit, on_write_back)
+				updates, errors = {}, []
+	finally:
+		if executor:
+			executor.shutdown()
 
-		return wa_msg
+	failed += len(errors)
+	write_back_results(updates, errors, commit, on_write_back, done=True)
+	return len(messages) - failed, failed
+
+def write_back_results(updates, errors, commit=False, on_write_back=None, done=False):
+	bulk_update_values('WhatsApp Message', updates)
+	if errors:
+		frappe.log_error('\n'.join(errors), title = _('Twilio WhatsApp Message Error'))
+	if on_write_back:
+		on_write_back(len(updates) - len(errors), len(errors), done)
+	if commit:
+		frappe.db.commit()
+
+@frappe.whitelist()
+def retry_dead_letter_messages():
+	frappe.only_for('System Manager')
+	frappe.enqueue(
+		'twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message.send_dead_letter_messages',
+		queue='long'
+	)
+
+def send_dead_letter_messages(batch_size=500):
+	"""Send the messages that were moved to `Dead Letter` once again, one batch at a time.
+	"""
+	last_name = ''
+	while True:
+		messages = frappe.get_all('WhatsApp Message',
+			filters={'status': 'Dead Letter', 'name': ['>', last_name]},
+			fields=['name', 'from_', 'to', 'message', 'media_link'],
+			order_by='name asc',
+			limit_page_length=batch_size
+		)
+		if not messages:
+			break
+		dispatch_messages(messages, commit=True)
+		last_name = messages[-1].name
+
+def queue_whatsapp_message(receiver_list, message, doctype, docname, media=None, group=None):
+	"""Send a WhatsApp message from a background job once the current transaction is committed.
+
+	Messages queued with the same `group` are collected in `frappe.flags` and sent by a single job.
+	The messages of a group are saved to redis on every call, and the job (enqueued after commit)
+	only gets their key, so it doesn't matter when the job arguments are serialized.
+	"""
+	queued = frappe.flags.setdefault('queued_whatsapp_messages', {})
+	pending = queued.get(group)
+	message = {
+		'receiver_list': receiver_list,
+		'message': message,
+		'doctype': doctype,
+		'docname': docname,
+		'media': media
+	}
+
+	cache = frappe.cache()
+	if pending:
+		pending['messages'].append(message)
+		# Fails if the job has already taken the messages, e.g. after an intermediate commit.
+		if cache.set(pending['key'], dumps(pending['messages'], default=str), xx=True, ex=QUEUED_MESSAGES_EXPIRY):
+			return
+
+	pending = queued[group] = {
+		'key': cache.make_key(QUEUED_MESSAGES_CACHE_KEY + frappe.generate_hash(length=12)),
+		'messages': [message]
+	}
+	cache.set(pending['key'], dumps(pending['messages'], default=str), ex=QUEUED_MESSAGES_EXPIRY)
+	frappe.enqueue(
+		'twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message.send_queued_whatsapp_messages',
+		queue='short',
+		enqueue_after_commit=True,
+		key=pending['key']
+	)
+
+def send_queued_whatsapp_messages(key):
+	"""Send the messages queued by `queue_whatsapp_message` under the given key.
+	"""
+	cache = frappe.cache()
+	pipe = cache.pipeline()
+	pipe.get(key)
+	pipe.delete(key)
+	messages, _ = pipe.execute()
+	for message in loads(messages or '[]'):
+		WhatsAppMessage.send_whatsapp_message(**message, commit=True)
+
+def apply_status_updates(events):
+	"""Apply status callback events of sent messages with a single batched update.
+	Events of a message are collapsed to its latest status, and a status never moves backwards.
+	Returns the changes as `{'name', 'id', 'status', 'conversation'}` dicts, and the events
+	of messages that are not saved yet (callbacks can arrive before the sent message is stored).
+	"""
+	latest = {}
+	for event in events:
+		status = (event['status'] or '').title()
+		if STATUS_RANK.get(status, 0) >= STATUS_RANK.get(latest.get(event['id']), 0):
+			latest[event['id']] = status
+
+	if not latest:
+		return [], []
+
+	changes, found = [], set()
+	for message in frappe.get_all('WhatsApp Message',
+			filters={'id': ['in', list(latest)]},
+			fields=['name', 'id', 'status', 'conversation']):
+		found.add(message.id)
+		status = latest[message.id]
+		if message.status != status and STATUS_RANK.get(status, 0) >= STATUS_RANK.get(message.status, 0):
+			changes.append(dict(message, status=status))
+
+	bulk_update_values('WhatsApp Message', {change['id']: {'status': change['status']} for change in changes},
+		key_field='id')
+	return changes, [event for event in events if event['id'] not in found]
+
+def on_doctype_update():
+	frappe.db.add_index("WhatsApp Message", ["reference_doctype", "reference_document_name"])
+	frappe.db.add_index("WhatsApp Message", ["conversation", "creation"])
+
+def store_incoming_messages(events):
+	"""Save buffered incoming messages with a multi-row insert.
+	Twilio retries webhooks, so messages are deduplicated on their SID (`id` is unique).
+	"""
+	incoming = {event['id']: event for event in events if event.get('id')}
+	if not incoming:
+		return []
+
+	existing = set(frappe.get_all('WhatsApp Message', filters={'id': ['in', list(incoming)]}, pluck='id'))
+	messages = [frappe._dict(event, name=frappe.generate_hash('WhatsApp Message', 10),
+		sent_received='Received', status='Received')
+		for sid, event in incoming.items() if sid not in existing]
+	set_conversation(messages)
+
+	if messages:
+		now = frappe.utils.now()
+		fields = ['name', 'from_', 'to', 'message', 'profile_name', 'sent_received', 'id', 'send_on', 'status',
+			'conversation']
+		# Messages are created at the time their webhook was received, so that a conversation
+		# (ordered by `creation`) keeps the order of the messages of a buffered batch.
+		frappe.db.bulk_insert('WhatsApp Message',
+			fields=fields + ['creation', 'modified', 'owner', 'modified_by', 'docstatus'],
+			values=[[m.get(f) for f in fields] + [m.get('send_on') or now, now, 'Guest', 'Guest', 0]
+				for m in messages],
+			ignore_duplicates=True
+		)
+		update_conversations(messages)
+	return messages
 
 def incoming_message_callback(args):
+	if WhatsAppMessage.get_by_sid(args.MessageSid):
+		return
+
 	wa_msg = frappe.get_doc({
 			'doctype': 'WhatsApp Message',
 			'from_': args.From,
@@ -75,5 +334,9 @@ def incoming_message_callback(args):
 			'id': args.MessageSid,
 			'send_on': frappe.utils.now(),
 			'status': 'Received'
-		}).insert(ignore_permissions=True)
-
+		})
+	try:
+		wa_msg.insert(ignore_permissions=True)
+	except frappe.DuplicateEntryError:
+		# Saved by a concurrent retry of the same webhook.
+		pass
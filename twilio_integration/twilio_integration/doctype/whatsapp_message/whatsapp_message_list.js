@@ -0,0 +1,25 @@
+frappe.listview_settings['WhatsApp Message'] = {
+	onload: function(listview) {
+		// Status callbacks are applied in batches, refresh only when a visible message has changed.
+		frappe.realtime.on('whatsapp_message_status', (data) => {
+			const names = new Set((listview.data || []).map((message) => message.name));
+			if (data.updates.some((update) => names.has(update.name))) {
+				listview.refresh();
+			}
+		});
+
+		if (!frappe.user_roles.includes('System Manager')) return;
+
+		listview.page.add_menu_item(__('Retry Dead Letter Messages'), function() {
+			frappe.call({
+				method: 'twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message.retry_dead_letter_messages',
+				callback: () => {
+					frappe.show_alert({
+						message: __('Dead letter messages are queued to be sent again.'),
+						indicator: 'green'
+					});
+				}
+			});
+		});
+	}
+};
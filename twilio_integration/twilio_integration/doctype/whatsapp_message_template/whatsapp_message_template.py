@@ -3,6 +3,15 @@
 
 # import frappe
 from frappe.model.document import Document
+from ...message_template import CompiledTemplate, clear_message_template_cache
 
 class WhatsAppMessageTemplate(Document):
-	pass
+	def validate(self):
+		# Fail on syntax errors while saving rather than while sending.
+		CompiledTemplate(self.message or '')
+
+	def on_update(self):
+		clear_message_template_cache(self.name)
+
+	def on_trash(self):
+		clear_message_template_cache(self.name)
@@ -0,0 +1,312 @@
+"""Local stand-in for the Twilio REST API, to load test the app without using (and paying for) the live API.
+
+Point the site at it and run it next to the bench:
+
+	bench --site mysite set-config twilio_transport_url http://localhost:8089
+	./env/bin/python -m twilio_integration.twilio_integration.fake_twilio --port 8089 --latency 0.1 --rate 20
+
+The server only needs the standard library, so it can also be started as a script on another machine.
+
+Serves the resources used by the app (accounts, keys, applications, incoming phone numbers,
+messages and calls), simulates API latency and per sender throttling (HTTP 429, error 20429), and
+posts message status callbacks (sent, delivered, read) to the `StatusCallback` of every message.
+Counters are served at `GET /_stats` and reset with `POST /_stats`.
+"""
+import re
+import json
+import time
+import heapq
+import random
+import argparse
+import threading
+import urllib.request
+from urllib.parse import urlsplit, parse_qs, urlencode
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+API_PREFIX = r'^/2010-04-01/Accounts/(?P<account_sid>AC\w+)'
+
+
+def make_sid(prefix):
+	return prefix + ''.join(random.choice('0123456789abcdef') for _ in range(32))
+
+
+def now_rfc2822():
+	return formatdate(time.time(), usegmt=True)
+
+
+class TokenBucket:
+	def __init__(self, rate):
+		self.rate = rate
+		self.tokens = rate
+		self.ts = time.monotonic()
+		self.lock = threading.Lock()
+
+	def take(self):
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min(self.rate, self.tokens + (now - self.ts) * self.rate)
+			self.ts = now
+			if self.tokens < 1:
+				return False
+			self.tokens -= 1
+			return True
+
+
+class CallbackSender(threading.Thread):
+	"""Posts scheduled webhooks in the background, in the order they are due.
+	"""
+	def __init__(self, stats):
+		super().__init__(daemon=True)
+		self.queue = []
+		self.condition = threading.Condition()
+		self.stats = stats
+
+	def schedule(self, delay, url, data):
+		with self.condition:
+			heapq.heappush(self.queue, (time.time() + delay, random.random(), url, data))
+			self.condition.notify()
+
+	def run(self):
+		while True:
+			with self.condition:
+				while not self.queue or self.queue[0][0] > time.time():
+					self.condition.wait(self.queue[0][0] - time.time() if self.queue else None)
+				_, _, url, data = heapq.heappop(self.queue)
+			try:
+				urllib.request.urlopen(url, data=urlencode(data).encode(), timeout=30).read()
+				self.stats.incr('callbacks_sent')
+			except Exception:
+				self.stats.incr('callbacks_failed')
+
+
+class Stats:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.counters = {'started_at': time.time()}
+
+	def incr(self, key, value=1):
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	def as_dict(self):
+		with self.lock:
+			return dict(self.counters, elapsed=time.time() - self.counters['started_at'])
+
+
+class FakeTwilio:
+	def __init__(self, latency=0.0, jitter=0.0, rate=0, callback_delay=0.5, failure_rate=0.0,
+			callbacks=True, phone_numbers=None):
+		self.latency = latency
+		self.jitter = jitter
+		self.rate = rate
+		self.callback_delay = callback_delay
+		self.failure_rate = failure_rate
+		self.callbacks = callbacks
+		self.phone_numbers = phone_numbers or ['+15005550006']
+		self.buckets = {}
+		self.buckets_lock = threading.Lock()
+		self.applications = []
+		self.stats = Stats()
+		self.callback_sender = CallbackSender(self.stats)
+		self.callback_sender.start()
+		self.routes = [
+			('GET', API_PREFIX + r'\.json$', self.fetch_account),
+			('POST', API_PREFIX + r'/Keys\.json$', self.create_key),
+			('GET', API_PREFIX + r'/Applications\.json$', self.list_applications),
+			('POST', API_PREFIX + r'/Applications\.json$', self.create_application),
+			('GET', API_PREFIX + r'/IncomingPhoneNumbers\.json$', self.list_phone_numbers),
+			('POST', API_PREFIX + r'/Messages\.json$', self.create_message),
+			('GET', API_PREFIX + r'/Calls/(?P<call_sid>\w+)\.json$', self.fetch_call),
+		]
+
+	def handle(self, method, path, params):
+		for route_method, pattern, handler in self.routes:
+			match = re.match(pattern, path)
+			if route_method == method and match:
+				time.sleep(max(0, random.gauss(self.latency, self.jitter)) if self.jitter else self.latency)
+				return handler(params, **match.groupdict())
+		return 404, error(20404, 'The requested resource {0} was not found'.format(path), 404)
+
+	def throttled(self, sender):
+		if not self.rate:
+			return False
+		with self.buckets_lock:
+			bucket = self.buckets.setdefault(sender, TokenBucket(self.rate))
+		return not bucket.take()
+
+	def fetch_account(self, params, account_sid):
+		return 200, {'sid': account_sid, 'friendly_name': 'Fake Twilio', 'status': 'active', 'type': 'Full'}
+
+	def create_key(self, params, account_sid):
+		return 201, {'sid': make_sid('SK'), 'secret': make_sid(''), 'friendly_name': params.get('FriendlyName'),
+			'date_created': now_rfc2822(), 'date_updated': now_rfc2822()}
+
+	def list_applications(self, params, account_sid):
+		name = params.get('FriendlyName')
+		applications = [a for a in self.applications if not name or a['friendly_name'] == name]
+		return 200, page('applications', applications, account_sid, 'Applications')
+
+	def create_application(self, params, account_sid):
+		application = {'sid': make_sid('AP'), 'account_sid': account_sid,
+			'friendly_name': params.get('FriendlyName'), 'voice_url': params.get('VoiceUrl'),
+			'voice_method': params.get('VoiceMethod')}
+		self.applications.append(application)
+		return 201, application
+
+	def list_phone_numbers(self, params, account_sid):
+		numbers = [{'sid': make_sid('PN'), 'account_sid': account_sid, 'phone_number': number,
+			'friendly_name': number} for number in self.phone_numbers]
+		return 200, page('incoming_phone_numbers', numbers, account_sid, 'IncomingPhoneNumbers')
+
+	def create_message(self, params, account_sid):
+		self.stats.incr('messages_requested')
+		sender = params.get('From')
+		if self.throttled(sender):
+			self.stats.incr('messages_throttled')
+			return 429, error(20429, 'Too Many Requests', 429)
+
+		sid = make_sid('SM')
+		self.stats.incr('messages_created')
+		if self.callbacks and params.get('StatusCallback'):
+			statuses = ['sent', 'undelivered'] if random.random() < self.failure_rate else ['sent', 'delivered', 'read']
+			for i, status in enumerate(statuses, 1):
+				self.callback_sender.schedule(self.callback_delay * i, params['StatusCallback'], {
+					'AccountSid': account_sid,
+					'MessageSid': sid,
+					'SmsSid': sid,
+					'MessageStatus': status,
+					'SmsStatus': status,
+					'From': sender,
+					'To': params.get('To')
+				})
+
+		return 201, {
+			'sid': sid,
+			'account_sid': account_sid,
+			'from': sender,
+			'to': params.get('To'),
+			'body': params.get('Body'),
+			'status': 'queued',
+			'num_media': str(len(params.getlist('MediaUrl'))),
+			'direction': 'outbound-api',
+			'date_created': now_rfc2822(),
+			'date_updated': now_rfc2822(),
+			'date_sent': None,
+			'price': None,
+			'error_code': None,
+			'error_message': None,
+			'uri': '/2010-04-01/Accounts/{0}/Messages/{1}.json'.format(account_sid, sid)
+		}
+
+	def fetch_call(self, params, account_sid, call_sid):
+		return 200, {'sid': call_sid, 'account_sid': account_sid, 'status': 'completed',
+			'duration': str(random.randint(10, 300)), 'direction': 'inbound',
+			'date_created': now_rfc2822(), 'date_updated': now_rfc2822()}
+
+
+class Params(dict):
+	"""Form or query parameters, first value of every key (`getlist` returns all of them).
+	"""
+	def __init__(self, parsed):
+		super().__init__({key: values[0] for key, values in parsed.items()})
+		self.parsed = parsed
+
+	def getlist(self, key):
+		return self.parsed.get(key, [])
+
+
+def page(key, records, account_sid, resource):
+	uri = '/2010-04-01/Accounts/{0}/{1}.json'.format(account_sid, resource)
+	return {key: records, 'page': 0, 'page_size': 50, 'start': 0, 'end': max(len(records) - 1, 0),
+		'uri': uri, 'first_page_uri': uri, 'next_page_uri': None, 'previous_page_uri': None}
+
+
+def error(code, message, status):
+	return {'code': code, 'message': message, 'more_info': 'https://www.twilio.com/docs/errors/{0}'.format(code),
+		'status': status}
+
+
+def make_handler(fake):
+	class Handler(BaseHTTPRequestHandler):
+		protocol_version = 'HTTP/1.1'
+
+		def do_GET(self):
+			self.dispatch('GET')
+
+		def do_POST(self):
+			self.dispatch('POST')
+
+		def dispatch(self, method):
+			parts = urlsplit(self.path)
+			length = int(self.headers.get('Content-Length') or 0)
+			body = self.rfile.read(length).decode() if length else ''
+
+			if parts.path == '/_stats':
+				if method == 'POST':
+					fake.stats.reset()
+				return self.respond(200, fake.stats.as_dict())
+
+			params = Params(parse_qs(body if method == 'POST' else parts.query, keep_blank_values=True))
+			fake.stats.incr('requests')
+			status, payload = fake.handle(method, parts.path, params)
+			self.respond(status, payload)
+
+		def respond(self, status, payload):
+			body = json.dumps(payload).encode()
+			self.send_response(status)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			pass
+
+	return Handler
+
+
+def make_server(host='127.0.0.1', port=8089, **kwargs):
+	fake = FakeTwilio(**kwargs)
+	server = ThreadingHTTPServer((host, port), make_handler(fake))
+	server.daemon_threads = True
+	server.fake = fake
+	return server
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Fake Twilio REST API for load testing.')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8089)
+	parser.add_argument('--latency', type=float, default=0.1, help='Seconds taken by every API request.')
+	parser.add_argument('--jitter', type=float, default=0.0, help='Standard deviation of the latency.')
+	parser.add_argument('--rate', type=float, default=0, help='Messages per second allowed per sender, 0 for no limit.')
+	parser.add_argument('--callback-delay', type=float, default=0.5, help='Seconds between status callbacks.')
+	parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of messages that are undelivered.')
+	parser.add_argument('--no-callbacks', action='store_true', help='Do not post status callbacks.')
+	parser.add_argument('--phone-number', action='append', dest='phone_numbers',
+		help='Incoming phone number of the account, can be repeated.')
+	args = parser.parse_args()
+
+	server = make_server(args.host, args.port,
+		latency=args.latency,
+		jitter=args.jitter,
+		rate=args.rate,
+		callback_delay=args.callback_delay,
+		failure_rate=args.failure_rate,
+		callbacks=not args.no_callbacks,
+		phone_numbers=args.phone_numbers
+	)
+	print('Fake Twilio listening on http://{0}:{1}'.format(args.host, args.port))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,92 @@
+import os
+import shutil
+import hashlib
+
+import frappe
+from frappe import _
+from frappe.utils import get_site_url
+from .utils import get_twilio_settings
+
+# Content hash -> path of the staged copy of a media file.
+MEDIA_CACHE_KEY = 'twilio_media_path'
+# Staged files are named after their content hash and never change, so they can be cached for ever.
+MEDIA_FOLDER = 'twilio_media'
+# Media accepted by WhatsApp, up to 16MB.
+SUPPORTED_FILE_EXTENSIONS = ('jpg', 'jpeg', 'png', 'mp3', 'ogg', 'amr', 'pdf', 'mp4')
+MAX_MEDIA_SIZE = 16777216
+
+
+def get_attachment(doctype: str, name: str):
+	"""Get the public file attached to a document, if any.
+	"""
+	file = frappe.db.get_value('File', {
+		'attached_to_doctype': doctype,
+		'attached_to_name': name,
+		'is_private': 0
+	}, 'name')
+	return file and frappe.get_doc('File', file)
+
+
+def validate_media(file_doc):
+	"""Make sure that the file can be sent with a WhatsApp message.
+	"""
+	if (file_doc.file_size or 0) > MAX_MEDIA_SIZE:
+		frappe.throw(_('Attachment size must be less than 16MB.'))
+
+	if file_doc.is_private:
+		frappe.throw(_('Attachment must be public.'))
+
+	if get_file_extension(file_doc.file_name).lstrip('.') not in SUPPORTED_FILE_EXTENSIONS:
+		frappe.throw(_('Attachment format not supported.'))
+
+
+def get_media_url(file_doc):
+	"""Get the URL twilio fetches the media of a message from.
+
+	The file is staged once under `/files/twilio_media/<content hash>.<extension>` and the same URL is used
+	by every message and campaign sending the same content. Staged files are immutable, so the path can be
+	served with long lived cache headers and fronted by a CDN (`Media Base URL` in Twilio Settings).
+	"""
+	if frappe.utils.validate_url(file_doc.file_url or ''):
+		# File is hosted elsewhere.
+		return file_doc.file_url
+
+	content_hash = file_doc.content_hash or get_content_hash(file_doc)
+	path = frappe.cache().hget(MEDIA_CACHE_KEY, content_hash,
+		generator=lambda: stage_media(file_doc, content_hash))
+	if not os.path.exists(frappe.get_site_path('public', path.lstrip('/'))):
+		# Cached by another bench or deleted, stage it again.
+		path = stage_media(file_doc, content_hash)
+		frappe.cache().hset(MEDIA_CACHE_KEY, content_hash, path)
+
+	base_url = get_twilio_settings().media_base_url or get_site_url(frappe.local.site)
+	return base_url.rstrip('/') + path
+
+
+def stage_media(file_doc, content_hash):
+	file_name = content_hash + get_file_extension(file_doc.file_name)
+	folder = frappe.get_site_path('public', 'files', MEDIA_FOLDER)
+	target = os.path.join(folder, file_name)
+
+	if not os.path.exists(target):
+		os.makedirs(folder, exist_ok=True)
+		# Copy to a temporary file first, so that a partially copied file is never served.
+		temp = '{0}.{1}.tmp'.format(target, frappe.generate_hash(length=8))
+		shutil.copyfile(file_doc.get_full_path(), temp)
+		os.replace(temp, target)
+
+	return '/files/{0}/{1}'.format(MEDIA_FOLDER, file_name)
+
+
+def get_content_hash(file_doc):
+	md5 = hashlib.md5()
+	with open(file_doc.get_full_path(), 'rb') as f:
+		for block in iter(lambda: f.read(1024 * 1024), b''):
+			md5.update(block)
+	return md5.hexdigest()
+
+
+def get_file_extension(file_name: str):
+	"""Lower case extension of the file name with the dot, e.g. `.pdf`.
+	"""
+	return os.path.splitext(file_name or '')[1].lower()
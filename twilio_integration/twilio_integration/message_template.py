@@ -0,0 +1,89 @@
+import frappe
+from frappe import _
+from jinja2 import meta
+from frappe.utils.jinja import get_jenv
+
+# `WhatsApp Message Template` name -> message and modified timestamp, cleared when the template is changed.
+TEMPLATE_CACHE_KEY = 'twilio_whatsapp_template'
+# Compiled templates of this process by (site, key), a template is compiled again when it is modified.
+MAX_COMPILED_TEMPLATES = 256
+_compiled_templates = {}
+
+
+class CompiledTemplate:
+	"""Jinja template parsed and compiled once, to be rendered many times.
+
+	Only the compiled code is kept, it is bound to the jinja environment of the current request
+	(with its fresh globals) whenever the template is rendered.
+	"""
+	def __init__(self, source):
+		# Same restriction as `frappe.render_template`.
+		if '.__' in source:
+			frappe.throw(_('Illegal template'))
+
+		jenv = get_jenv()
+		self.source = source
+		self.code = jenv.compile(source)
+		self.variables = meta.find_undeclared_variables(jenv.parse(source))
+
+	def uses(self, variable):
+		return variable in self.variables
+
+	def get_template(self):
+		jenv = get_jenv()
+		return jenv.template_class.from_code(jenv, self.code, jenv.make_globals(None))
+
+	def render(self, context=None):
+		return self.get_template().render(context or {})
+
+	def render_for_docs(self, docs, context=None):
+		"""Render the template once for every document (available as `doc` in the template).
+		"""
+		template = self.get_template()
+		context = dict(context or {})
+		messages = []
+		for doc in docs:
+			context['doc'] = doc
+			messages.append(template.render(context))
+		return messages
+
+
+def get_compiled_template(key, source, modified=None):
+	"""Get the compiled template cached by key (e.g. doctype and name) and modified timestamp.
+	>>> get_compiled_template(('Notification', 'Order Shipped'), notification.message, notification.modified)
+	"""
+	source = source or ''
+	cache_key = (frappe.local.site, key)
+	cached = _compiled_templates.get(cache_key)
+	# Source is compared as well, messages of standard notifications are loaded from files.
+	if cached and cached[0] == str(modified) and cached[1].source == source:
+		return cached[1]
+
+	template = CompiledTemplate(source)
+	_compiled_templates.pop(cache_key, None)
+	if len(_compiled_templates) >= MAX_COMPILED_TEMPLATES:
+		_compiled_templates.pop(next(iter(_compiled_templates)))
+	_compiled_templates[cache_key] = (str(modified), template)
+	return template
+
+
+def get_message_template(name):
+	"""Get the compiled message of a `WhatsApp Message Template`.
+	"""
+	template = frappe.cache().hget(TEMPLATE_CACHE_KEY, name,
+		generator=lambda: frappe.db.get_value('WhatsApp Message Template', name, ['message', 'modified'], as_dict=True))
+	if not template:
+		frappe.throw(_('WhatsApp Message Template {0} not found').format(frappe.bold(name)))
+	return get_compiled_template(('WhatsApp Message Template', name), template.message, template.modified)
+
+
+def clear_message_template_cache(name):
+	# Other processes may cache the old template again before this transaction is committed,
+	# so it is dropped once again after the commit.
+	drop_message_template_cache(name)
+	frappe.enqueue('twilio_integration.twilio_integration.message_template.drop_message_template_cache',
+		queue='short', enqueue_after_commit=True, name=name)
+
+
+def drop_message_template_cache(name):
+	frappe.cache().hdel(TEMPLATE_CACHE_KEY, name)
@@ -0,0 +1,24 @@
+# Copyright (c) 2021, Frappe and Contributors
+# See license.txt
+
+import unittest
+from unittest.mock import patch
+
+from twilio.base.exceptions import TwilioRestException
+from twilio_integration.twilio_integration.throttle import get_backoff, is_throttle_error
+
+class TestThrottle(unittest.TestCase):
+	def test_backoff_is_capped(self):
+		with patch('random.uniform', side_effect=lambda low, high: high):
+			self.assertEqual([get_backoff(attempt) for attempt in range(7)], [1, 2, 4, 8, 16, 30, 30])
+			self.assertEqual(get_backoff(2, base=0.5, cap=10), 2)
+
+	def test_backoff_has_jitter(self):
+		for attempt in range(10):
+			self.assertTrue(0 <= get_backoff(attempt) <= min(30, 2 ** attempt))
+
+	def test_throttle_errors(self):
+		self.assertTrue(is_throttle_error(TwilioRestException(429, '/Messages.json', 'Too Many Requests', 20429)))
+		self.assertTrue(is_throttle_error(TwilioRestException(400, '/Messages.json', 'Queue overflow', 63018)))
+		self.assertFalse(is_throttle_error(TwilioRestException(400, '/Messages.json', 'Invalid number', 21211)))
+		self.assertFalse(is_throttle_error(ValueError('not a twilio error')))
@@ -0,0 +1,59 @@
+# Copyright (c) 2021, Frappe and Contributors
+# See license.txt
+
+import unittest
+from unittest.mock import patch, MagicMock
+
+import frappe
+from twilio_integration.twilio_integration.utils import normalize_phone_number, bulk_update_values
+
+class TestNormalizePhoneNumber(unittest.TestCase):
+	def test_numbers_with_country_code(self):
+		self.assertEqual(normalize_phone_number('+1 (415) 523-8886'), '+14155238886')
+		self.assertEqual(normalize_phone_number('0091 98765-43210'), '+919876543210')
+		self.assertEqual(normalize_phone_number(' +44 20 7946 0958 '), '+442079460958')
+		self.assertEqual(normalize_phone_number('+683 4002'), '+6834002')
+
+	def test_whatsapp_address(self):
+		self.assertEqual(normalize_phone_number('whatsapp:+14155238886'), '+14155238886')
+
+	def test_numbers_without_country_code(self):
+		self.assertIsNone(normalize_phone_number('98765 43210'))
+		self.assertIsNone(normalize_phone_number('(415) 523-8886'))
+
+	def test_invalid_numbers(self):
+		for number in (None, '', '+', '00', '+0000', '+12', '+123456', '0001234567', '+1234567890123456'):
+			self.assertIsNone(normalize_phone_number(number), number)
+
+class TestBulkUpdateValues(unittest.TestCase):
+	def bulk_update(self, *args, **kwargs):
+		db = MagicMock()
+		with patch.object(frappe, 'db', db), patch('frappe.utils.now', return_value='2021-08-30 10:00:00'):
+			bulk_update_values(*args, **kwargs)
+		return [(' '.join(c.args[0].split()), c.args[1]) for c in db.sql.call_args_list]
+
+	def test_update_query(self):
+		queries = self.bulk_update('WhatsApp Message', {
+			'name1': {'status': 'Sent', 'id': 'SM1'},
+			'name2': {'status': 'Error'}
+		})
+		self.assertEqual(queries, [(
+			"UPDATE `tabWhatsApp Message` SET "
+			"`id` = CASE `name` WHEN %s THEN %s ELSE `id` END, "
+			"`status` = CASE `name` WHEN %s THEN %s WHEN %s THEN %s ELSE `status` END, "
+			"`modified` = %s WHERE `name` IN (%s, %s)",
+			('name1', 'SM1', 'name1', 'Sent', 'name2', 'Error', '2021-08-30 10:00:00', 'name1', 'name2')
+		)])
+
+	def test_key_field_and_batches(self):
+		queries = self.bulk_update('WhatsApp Message', {
+			'SM1': {'status': 'Read'},
+			'SM2': {'status': 'Delivered'},
+			'SM3': {'status': 'Failed'}
+		}, key_field='id', batch_size=2)
+		self.assertEqual(len(queries), 2)
+		self.assertTrue(queries[0][0].endswith('WHERE `id` IN (%s, %s)'))
+		self.assertEqual(queries[1][1], ('SM3', 'Failed', '2021-08-30 10:00:00', 'SM3'))
+
+	def test_no_updates(self):
+		self.assertEqual(self.bulk_update('WhatsApp Message', {}), [])
@@ -0,0 +1,63 @@
+import time
+import random
+
+import frappe
+
+# Twilio error codes returned when the account or sender is sending faster than allowed.
+# https://www.twilio.com/docs/api/errors/20429, https://www.twilio.com/docs/api/errors/63018
+THROTTLE_ERROR_CODES = (20429, 63018)
+
+# Refill the bucket for the time elapsed since the last call and take a token if there is one.
+# Returns the seconds to wait for the next token (as string, lua numbers are truncated to integers).
+TOKEN_BUCKET_SCRIPT = """
+local rate, capacity, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local wait = 0
+if tokens >= 1 then
+	tokens = tokens - 1
+else
+	wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+
+class TokenBucket:
+	"""Rate limiter shared by all workers and threads through redis.
+	>>> bucket = TokenBucket('whatsapp:+14155238886', rate=20)
+	>>> bucket.acquire() # blocks until a token is available
+
+	Bucket must be created in the main thread (redis key depends on the site),
+	`acquire` can then be called from any thread.
+	"""
+	def __init__(self, name, rate=None, capacity=None):
+		self.rate = rate
+		self.capacity = capacity or rate
+		self.redis = frappe.cache()
+		self.key = self.redis.make_key('twilio_send_rate|' + name)
+
+	def acquire(self):
+		if not self.rate:
+			return
+
+		while True:
+			wait = float(self.redis.eval(TOKEN_BUCKET_SCRIPT, 1, self.key, self.rate, self.capacity, time.time()))
+			if wait <= 0:
+				return
+			time.sleep(wait)
+
+
+def is_throttle_error(error):
+	return getattr(error, 'status', None) == 429 or getattr(error, 'code', None) in THROTTLE_ERROR_CODES
+
+
+def get_backoff(attempt, base=1, cap=30):
+	"""Exponential backoff with full jitter.
+	"""
+	return random.uniform(0, min(cap, base * 2 ** attempt))
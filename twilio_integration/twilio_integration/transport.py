@@ -0,0 +1,20 @@
+from urllib.parse import urlsplit
+
+from twilio.http.http_client import TwilioHttpClient
+
+
+class RedirectHttpClient(TwilioHttpClient):
+	"""Twilio HTTP client that sends every API request to another server instead of `*.twilio.com`,
+	e.g. the bundled fake server (`fake_twilio.py`) to load test without using the live API.
+
+	Enabled by `twilio_transport_url` in site config:
+	>>> bench --site mysite set-config twilio_transport_url http://localhost:8089
+	"""
+	def __init__(self, base_url, **kwargs):
+		super().__init__(**kwargs)
+		self.base_url = base_url.rstrip('/')
+
+	def request(self, method, url, *args, **kwargs):
+		parts = urlsplit(url)
+		url = self.base_url + parts.path + ('?' + parts.query if parts.query else '')
+		return super().request(method, url, *args, **kwargs)
@@ -1,34 +1,83 @@
 import re
+from urllib.parse import urlencode
 import json
+import time
+import threading
+from requests.adapters import HTTPAdapter
 from twilio.rest import Client as TwilioClient
+from twilio.http.http_client import TwilioHttpClient
 from twilio.jwt.access_token import AccessToken
 from twilio.jwt.access_token.grants import VoiceGrant
 from twilio.twiml.voice_response import VoiceResponse, Dial
 
 import frappe
 from frappe import _
-from frappe.utils.password import get_decrypted_password
-from .utils import get_public_url, merge_dicts
+from .utils import get_public_url, merge_dicts, get_twilio_settings
+from .transport import RedirectHttpClient
+
+# Twilio REST clients are pooled per site, so that the HTTP session (and its
+# keep-alive connections to api.twilio.com) is reused across requests and jobs.
+# Client is rebuilt whenever the settings snapshot it was built from is replaced.
+_client_pool = {}
+_client_pool_lock = threading.Lock()
+# Campaigns send through a pool of threads, so keep enough connections open to serve all of them.
+HTTP_POOL_SIZE = 32
+
+# Call routing table (twilio number -> owners) is cached in redis and in process memory.
+ROUTING_CACHE_KEY = 'twilio_number_owners'
+ROUTING_VERSION_CACHE_KEY = 'twilio_routing_version'
+_routing_cache = {}
+
+# Voice access tokens are cached per user and reissued when less than this many seconds are left.
+VOICE_TOKEN_CACHE_KEY = 'twilio_voice_token'
+VOICE_TOKEN_REFRESH_MARGIN = 5 * 60
+
+# Voice profile (twilio number, receiving device) of every user is cached in a redis hash.
+VOICE_PROFILE_CACHE_KEY = 'twilio_voice_profile'
+
+# Agent presence is kept in redis sorted sets scored by unix time.
+# Browser softphones send a heartbeat every 30 seconds (see twilio_call_handler.js), whereas
+# agents are marked on a call from call status callbacks, which don't depend on the browser tab.
+AGENT_PRESENCE_CACHE_KEY = 'twilio_agent_presence'
+AGENT_ON_CALL_CACHE_KEY = 'twilio_agent_on_call'
+AGENT_LAST_ROUTED_CACHE_KEY = 'twilio_agent_last_routed'
+AGENT_PRESENCE_TIMEOUT = 90
+AGENT_ON_CALL_TIMEOUT = 4 * 60 * 60
+
+# Pick the least recently routed agent out of the candidates and mark it as routed, atomically.
+SELECT_AGENT_SCRIPT = """
+local best, best_score
+for i = 2, #ARGV do
+	local score = tonumber(redis.call('ZSCORE', KEYS[1], ARGV[i]) or 0)
+	if best == nil or score < best_score then
+		best, best_score = ARGV[i], score
+	end
+end
+if best then
+	redis.call('ZADD', KEYS[1], ARGV[1], best)
+end
+return best
+"""
 
 class Twilio:
 	"""Twilio connector over TwilioClient.
 	"""
 	def __init__(self, settings):
 		"""
-		:param settings: `Twilio Settings` doctype
+		:param settings: `Twilio Settings` snapshot (see `get_twilio_settings`)
 		"""
 		self.settings = settings
 		self.account_sid = settings.account_sid
 		self.application_sid = settings.twiml_sid
 		self.api_key = settings.api_key
-		self.api_secret = settings.get_password("api_secret")
+		self.api_secret = settings.api_secret
 		self.twilio_client = self.get_twilio_client()
 
 	@classmethod
 	def connect(self):
 		"""Make a twilio connection.
 		"""
-		settings = frappe.get_doc("Twilio Settings")
+		settings = get_twilio_settings()
 		if not (settings and settings.enabled):
 			return
 		return Twilio(settings=settings)
@@ -56,6 +105,30 @@ class Twilio:
 		token.add_grant(voice_grant)
 		return token.to_jwt()
 
+	def get_voice_access_token(self, identity: str):
+		"""Get the cached voice access token of the identity, a new token is signed
+		only when the cached one is about to expire or twilio credentials are changed.
+		>>> twilio.get_voice_access_token('agent@example.com')
+		{'token': 'eyJ...', 'expires_at': 1629457200.0, ...}
+		"""
+		cache_key = '{0}|{1}'.format(VOICE_TOKEN_CACHE_KEY, identity)
+		cached = frappe.cache().get_value(cache_key)
+		now = time.time()
+		if (cached and cached['api_key'] == self.api_key
+			and cached['application_sid'] == self.application_sid
+			and cached['expires_at'] - now > VOICE_TOKEN_REFRESH_MARGIN):
+			return cached
+
+		ttl = self.settings.voice_token_ttl or 60*60
+		token = {
+			'token': frappe.safe_decode(self.generate_voice_access_token(None, identity, ttl=ttl)),
+			'expires_at': now + ttl,
+			'api_key': self.api_key,
+			'application_sid': self.application_sid
+		}
+		frappe.cache().set_value(cache_key, token, expires_in_sec=ttl - VOICE_TOKEN_REFRESH_MARGIN)
+		return token
+
 	@classmethod
 	def safe_identity(cls, identity: str):
 		"""Create a safe identity by replacing unsupported special charaters `@` with (at)).
@@ -70,11 +143,19 @@ class Twilio:
 		"""
 		return identity.replace('(at)', '@')
 
+	def get_call_status_callback_url(self, identity: str=None):
+		"""Status callback of the dialed leg, identity of the agent is passed along to publish the status to the agent.
+		"""
+		url_path = "/api/method/twilio_integration.twilio_integration.api.call_status_callback"
+		if identity:
+			url_path += '?' + urlencode({'agent': identity})
+		return get_public_url(url_path)
+
 	def get_recording_status_callback_url(self):
 		url_path = "/api/method/twilio_integration.twilio_integration.api.update_recording_info"
 		return get_public_url(url_path)
 
-	def generate_twilio_dial_response(self, from_number: str, to_number: str):
+	def generate_twilio_dial_response(self, from_number: str, to_number: str, identity: str=None):
 		"""Generates voice call instructions to forward the call to agents Phone.
 		"""
 		resp = VoiceResponse()
@@ -84,7 +165,10 @@ class Twilio:
 			recording_status_callback=self.get_recording_status_callback_url(),
 			recording_status_callback_event='completed'
 		)
-		dial.number(to_number)
+		dial.number(to_number,
+			status_callback=self.get_call_status_callback_url(identity),
+			status_callback_event='answered completed'
+		)
 		resp.append(dial)
 		return resp
 
@@ -101,21 +185,49 @@ class Twilio:
 			recording_status_callback=self.get_recording_status_callback_url(),
 			recording_status_callback_event='completed'
 		)
-		dial.client(client)
+		dial.client(client,
+			status_callback=self.get_call_status_callback_url(client),
+			status_callback_event='answered completed'
+		)
 		resp.append(dial)
 		return resp
 
 	@classmethod
-	def get_twilio_client(self):
-		twilio_settings = frappe.get_doc("Twilio Settings")
+	def get_twilio_client(cls):
+		"""Get the pooled twilio client of the current site.
+		Client is built once per process and rebuilt only after `Twilio Settings` are updated.
+		"""
+		site = frappe.local.site
+		twilio_settings = get_twilio_settings()
+		pooled = _client_pool.get(site)
+		if pooled and pooled[0] is twilio_settings:
+			return pooled[1]
+
 		if not twilio_settings.enabled:
 			frappe.throw(_("Please enable twilio settings before sending WhatsApp messages"))
-		
-		auth_token = get_decrypted_password("Twilio Settings", "Twilio Settings", 'auth_token')
-		client = TwilioClient(twilio_settings.account_sid, auth_token)
 
+		client = cls.make_client(twilio_settings.account_sid, twilio_settings.auth_token)
+
+		with _client_pool_lock:
+			_client_pool[site] = (twilio_settings, client)
 		return client
 
+	@classmethod
+	def make_client(cls, account_sid, auth_token):
+		"""Create a twilio client that keeps its HTTP connections alive between requests.
+		Requests go to `twilio_transport_url` of site config instead of twilio when it is set.
+		"""
+		transport_url = frappe.conf.get('twilio_transport_url')
+		if transport_url:
+			http_client = RedirectHttpClient(transport_url, pool_connections=True)
+		else:
+			http_client = TwilioHttpClient(pool_connections=True)
+
+		adapter = HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE)
+		http_client.session.mount('https://', adapter)
+		http_client.session.mount('http://', adapter)
+		return TwilioClient(account_sid, auth_token, http_client=http_client)
+
 class IncomingCall:
 	def __init__(self, from_number, to_number, meta=None):
 		self.from_number = from_number
@@ -127,7 +239,6 @@ class IncomingCall:
 		* Figure out who is going to pick the call (call attender)
 		* Check call attender settings and forward the call to Phone
 		"""
-		twilio = Twilio.connect()
 		owners = get_twilio_number_owners(self.to_number)
 		attender = get_the_call_attender(owners)
 
@@ -136,8 +247,11 @@ class IncomingCall:
 			resp.say(_('Agent is unavailable to take the call, please call after some time.'))
 			return resp
 
+		twilio = Twilio.connect()
+
 		if attender['call_receiving_device'] == 'Phone':
-			return twilio.generate_twilio_dial_response(self.from_number, attender['mobile_no'])
+			return twilio.generate_twilio_dial_response(self.from_number, attender['mobile_no'],
+				identity=twilio.safe_identity(attender['name']))
 		else:
 			return twilio.generate_twilio_client_response(twilio.safe_identity(attender['name']))
 
@@ -189,39 +303,154 @@ def get_twilio_number_owners(phone_number):
 		'owner2': {....}
 	}
 	"""
+	site = frappe.local.site
+	version = frappe.cache().get_value(ROUTING_VERSION_CACHE_KEY)
+	routing_table = _routing_cache.get(site)
+	if not routing_table or routing_table['version'] != version:
+		routing_table = _routing_cache[site] = {'version': version, 'owners': {}}
+
+	owners = routing_table['owners'].get(phone_number)
+	if owners is None:
+		owners = frappe.cache().hget(ROUTING_CACHE_KEY, phone_number)
+		if owners is None:
+			owners = get_twilio_number_owners_from_db(phone_number)
+			# Numbers without owners are not cached, so that callers can't fill the cache with made up numbers.
+			if owners:
+				frappe.cache().hset(ROUTING_CACHE_KEY, phone_number, owners)
+		if owners:
+			routing_table['owners'][phone_number] = owners
+	return owners
+
+def get_twilio_number_owners_from_db(phone_number):
 	user_voice_settings = frappe.get_all(
 		'Voice Call Settings',
 		filters={'twilio_number': phone_number},
 		fields=["name", "call_receiving_device"]
 	)
 	user_wise_voice_settings = {user['name']: user for user in user_voice_settings}
+	if not user_wise_voice_settings:
+		return {}
 
 	user_general_settings = frappe.get_all(
 		'User',
-		filters = [['name', 'IN', user_wise_voice_settings.keys()]],
+		filters = [['name', 'IN', list(user_wise_voice_settings.keys())]],
 		fields = ['name', 'mobile_no']
 	)
 	user_wise_general_settings = {user['name']: user for user in user_general_settings}
 
 	return merge_dicts(user_wise_general_settings, user_wise_voice_settings)
 
+def clear_routing_cache(doc=None, method=None, users=None):
+	"""Drop the cached call routing table in all processes, and the voice profiles of the given users.
+	Called when `Voice Call Settings` or agents mobile numbers change.
+	"""
+	# Other processes may cache the old values again before this transaction is committed,
+	# so the caches are dropped once again after the commit.
+	drop_routing_cache(users)
+	frappe.enqueue('twilio_integration.twilio_integration.twilio_handler.drop_routing_cache',
+		queue='short', enqueue_after_commit=True, users=users)
+
+def drop_routing_cache(users=None):
+	frappe.cache().delete_value(ROUTING_CACHE_KEY)
+	frappe.cache().set_value(ROUTING_VERSION_CACHE_KEY, frappe.generate_hash(length=10))
+	for user in users or []:
+		frappe.cache().hdel(VOICE_PROFILE_CACHE_KEY, user)
+
+def on_voice_call_settings_update(doc, method=None):
+	clear_routing_cache(users=[doc.name])
+
+def get_voice_profile(user=None):
+	"""Get voice call settings of the user.
+	>>> get_voice_profile('agent@example.com')
+	{'twilio_number': '+11234567890', 'call_receiving_device': 'Computer', 'enabled': True}
+	"""
+	user = user or frappe.session.user
+	return frappe.cache().hget(VOICE_PROFILE_CACHE_KEY, user,
+		generator=lambda: get_voice_profile_from_db(user))
+
+def get_voice_profile_from_db(user):
+	settings = frappe.db.get_value('Voice Call Settings', user,
+		['twilio_number', 'call_receiving_device'], as_dict=True) or {}
+	return {
+		'twilio_number': settings.get('twilio_number'),
+		'call_receiving_device': settings.get('call_receiving_device'),
+		'enabled': bool(settings.get('twilio_number'))
+	}
+
+def on_user_update(doc, method=None):
+	if doc.has_value_changed('mobile_no'):
+		clear_routing_cache()
 
-def get_active_loggedin_users(users):
-	"""Filter the current loggedin users from the given users list
+def set_agent_presence(user, status='available'):
+	"""Record heartbeat of an agent softphone.
+	`status` is `available` (softphone is online) or `offline`. Whether the agent is on a call
+	is only changed by `set_agent_on_call`, so an idle tab can't free an agent who is on a call.
 	"""
-	rows = frappe.db.sql("""
-		SELECT `user`
-		FROM `tabSessions`
-		WHERE `user` IN %(users)s
-		""", {'users': users})
-	return [row[0] for row in set(rows)]
+	cache = frappe.cache()
+	presence_key = cache.make_key(AGENT_PRESENCE_CACHE_KEY)
+
+	if status == 'offline':
+		cache.zrem(presence_key, user)
+	else:
+		cache.zadd(presence_key, {user: time.time()})
+
+def set_agent_on_call(user, on_call=True):
+	"""Mark the agent as on a call (or free), called when a call is routed or started by the agent
+	and from the status callbacks of the agent's call legs.
+	"""
+	cache = frappe.cache()
+	on_call_key = cache.make_key(AGENT_ON_CALL_CACHE_KEY)
+
+	if on_call:
+		cache.zadd(on_call_key, {user: time.time()})
+	else:
+		cache.zrem(on_call_key, user)
+
+def on_logout(login_manager=None):
+	set_agent_presence(frappe.session.user, 'offline')
+	set_agent_on_call(frappe.session.user, False)
+
+def get_available_agents(users, online=True):
+	"""Filter the agents who are not on a call and, when `online` is set, whose softphone is online.
+	"""
+	if not users: return []
+
+	cache, now = frappe.cache(), time.time()
+	presence_key = cache.make_key(AGENT_PRESENCE_CACHE_KEY)
+	on_call_key = cache.make_key(AGENT_ON_CALL_CACHE_KEY)
+
+	pipe = cache.pipeline()
+	for user in users:
+		pipe.zscore(presence_key, user)
+		pipe.zscore(on_call_key, user)
+	scores = pipe.execute()
+
+	available = []
+	for i, user in enumerate(users):
+		last_seen, on_call_since = scores[2 * i], scores[2 * i + 1]
+		if online and (not last_seen or now - last_seen > AGENT_PRESENCE_TIMEOUT):
+			continue
+		if on_call_since and now - on_call_since < AGENT_ON_CALL_TIMEOUT:
+			continue
+		available.append(user)
+	return available
 
 def get_the_call_attender(owners):
-	"""Get attender details from list of owners
+	"""Get attender details from list of owners.
+
+	Calls are distributed to the least recently routed agent among the ones who can take the call,
+	agents using phone need a mobile number and computer agents need to be online, neither can be on a call.
 	"""
 	if not owners: return
-	current_loggedin_users = get_active_loggedin_users(list(owners.keys()))
-	for name, details in owners.items():
-		if ((details['call_receiving_device'] == 'Phone' and details['mobile_no']) or
-			(details['call_receiving_device'] == 'Computer' and name in current_loggedin_users)):
-			return details
+	computer_agents = [name for name, details in owners.items() if details['call_receiving_device'] == 'Computer']
+	phone_agents = [name for name, details in owners.items()
+		if details['call_receiving_device'] == 'Phone' and details['mobile_no']]
+	candidates = get_available_agents(computer_agents) + get_available_agents(phone_agents, online=False)
+	if not candidates: return
+
+	cache = frappe.cache()
+	attender = cache.eval(SELECT_AGENT_SCRIPT, 1, cache.make_key(AGENT_LAST_ROUTED_CACHE_KEY), time.time(), *candidates)
+	attender = owners[frappe.safe_decode(attender)]
+	# Hold the agent till the status callback of the call leg frees them.
+	set_agent_on_call(attender['name'])
+	return attender
@@ -1,6 +1,53 @@
+import re
+import json
 from pyngrok import ngrok
 import frappe
 from frappe.utils import get_url
+from frappe.utils.password import get_decrypted_password
+
+# `Twilio Settings` are kept in process memory with decrypted secrets (never in redis),
+# a version stamp in redis tells every process when the settings are changed.
+SETTINGS_VERSION_CACHE_KEY = 'twilio_settings_version'
+SETTINGS_PASSWORD_FIELDS = ('auth_token', 'api_secret')
+_settings_cache = {}
+
+
+class TwilioSettingsSnapshot(frappe._dict):
+	"""Read only copy of `Twilio Settings`, password fields are decrypted.
+	"""
+	def _read_only(self, *args, **kwargs):
+		raise AttributeError('Twilio settings snapshot is read only')
+
+	__setattr__ = __setitem__ = __delattr__ = __delitem__ = _read_only
+	update = setdefault = pop = popitem = clear = _read_only
+
+
+def get_twilio_settings():
+	"""Get the settings snapshot of the current site.
+	>>> get_twilio_settings().whatsapp_no
+	'+14155238886'
+	"""
+	site = frappe.local.site
+	version = frappe.cache().get_value(SETTINGS_VERSION_CACHE_KEY)
+	cached = _settings_cache.get(site)
+	if cached and cached[0] == version:
+		return cached[1]
+
+	settings = frappe.get_doc('Twilio Settings').as_dict(no_default_fields=True)
+	for fieldname in SETTINGS_PASSWORD_FIELDS:
+		settings[fieldname] = get_decrypted_password('Twilio Settings', 'Twilio Settings',
+			fieldname, raise_exception=False)
+
+	snapshot = TwilioSettingsSnapshot(settings)
+	_settings_cache[site] = (version, snapshot)
+	return snapshot
+
+
+def clear_twilio_settings_cache():
+	"""Make every process reload the settings snapshot.
+	"""
+	frappe.cache().set_value(SETTINGS_VERSION_CACHE_KEY, frappe.generate_hash(length=10))
+	_settings_cache.pop(frappe.local.site, None)
 
 
 def get_public_url(path: str=None, use_ngrok: bool=False):
@@ -26,3 +73,160 @@ def merge_dicts(d1: dict, d2: dict):
 	... {'name1': {'age': 20, 'phone': '+xxx'}, 'name2': {'age': 30, 'phone': '+yyy'}}
 	"""
 	return {k:{**v, **d2.get(k, {})} for k, v in d1.items()}
+
+
+def normalize_phone_number(number: str):
+	"""Convert phone number (or `whatsapp:` address) into E.164 format.
+	Numbers must have the country code (`+` or `00` prefix), None is returned for the others.
+	>>> normalize_phone_number('0091 98765-43210')
+	'+919876543210'
+	>>> normalize_phone_number('98765 43210')
+	"""
+	number = (number or '').strip()
+	if number.lower().startswith('whatsapp:'):
+		number = number[len('whatsapp:'):].strip()
+
+	digits = re.sub(r'\D', '', number)
+	if number.startswith('00'):
+		digits = digits[2:]
+	elif not number.startswith('+'):
+		return None
+
+	# E.164 numbers start with a country code (which never starts with 0) and have at most 15 digits,
+	# the shortest numbers in use have 7 digits (e.g. +683 4002).
+	if not re.match(r'[1-9]\d{6,14}$', digits):
+		return None
+	return '+' + digits
+
+
+def bulk_update_values(doctype: str, updates: dict, key_field: str='name', batch_size: int=500):
+	"""Update many rows of a doctype with a few `UPDATE ... CASE` queries instead of one query per row.
+	>>> bulk_update_values('WhatsApp Message', {
+		'name1': {'status': 'Sent', 'id': 'SM1'},
+		'name2': {'status': 'Error'}
+	})
+	"""
+	keys = list(updates)
+	modified = frappe.utils.now()
+	for i in range(0, len(keys), batch_size):
+		batch = keys[i:i + batch_size]
+		fields = sorted({field for key in batch for field in updates[key]})
+		set_clauses, values = [], []
+		for field in fields:
+			cases = []
+			for key in batch:
+				if field in updates[key]:
+					cases.append('WHEN %s THEN %s')
+					values.extend([key, updates[key][field]])
+			set_clauses.append('`{0}` = CASE `{1}` {2} ELSE `{0}` END'.format(field, key_field, ' '.join(cases)))
+
+		values.append(modified)
+		values.extend(batch)
+		frappe.db.sql("""UPDATE `tab{doctype}` SET {set_clauses}, `modified` = %s
+			WHERE `{key_field}` IN ({keys})""".format(
+				doctype=doctype,
+				set_clauses=', '.join(set_clauses),
+				key_field=key_field,
+				keys=', '.join(['%s'] * len(batch))
+			), tuple(values))
+
+
+def push_to_buffer(buffer: str, item: dict, flush_method: str, queue: str='short'):
+	"""Append an item to a redis backed buffer and make sure that a job to flush the buffer is queued.
+	Used by webhooks to defer database writes till after the response is returned.
+	"""
+	cache = frappe.cache()
+	cache.rpush(cache.make_key(buffer), json.dumps(item, default=str))
+	if cache.set(cache.make_key(buffer + '_flush_queued'), 1, nx=True, ex=300):
+		frappe.enqueue(flush_method, queue=queue)
+
+
+def pop_from_buffer(buffer: str, batch_size: int=1000):
+	"""Atomically take the oldest `batch_size` items out of a buffer filled by `push_to_buffer`.
+	"""
+	cache = frappe.cache()
+	# Items pushed from now on need a new flush job.
+	cache.delete(cache.make_key(buffer + '_flush_queued'))
+
+	key = cache.make_key(buffer)
+	pipe = cache.pipeline()
+	pipe.lrange(key, 0, batch_size - 1)
+	pipe.ltrim(key, batch_size, -1)
+	items, _ = pipe.execute()
+	return [json.loads(item) for item in items]
+
+
+def flush_buffer(buffer: str, process, batch_size: int=1000):
+	"""Pass the items of a buffer to `process` in batches, committing after every batch.
+
+	When a batch fails its items are processed and committed one by one, so that one bad item
+	doesn't lose the whole batch. Items that still fail are moved to `<buffer>_dead_letter` and logged.
+	"""
+	while True:
+		items = pop_from_buffer(buffer, batch_size)
+		if not items:
+			break
+
+		try:
+			process(items)
+			frappe.db.commit()
+			continue
+		except Exception:
+			frappe.db.rollback()
+
+		failed = []
+		for item in items:
+			try:
+				process([item])
+				frappe.db.commit()
+			except Exception:
+				frappe.db.rollback()
+				failed.append(item)
+				traceback = frappe.get_traceback()
+
+		if failed:
+			cache = frappe.cache()
+			cache.rpush(cache.make_key(buffer + '_dead_letter'), *[json.dumps(item, default=str) for item in failed])
+			frappe.log_error(title='Failed to process {0} items of {1}'.format(len(failed), buffer),
+				message=traceback)
+			frappe.db.commit()
+
+
+def retry_later(buffer: str, items: list):
+	"""Park buffered items that can not be processed yet, `requeue_retries` moves them back to the buffer.
+	"""
+	if items:
+		cache = frappe.cache()
+		cache.rpush(cache.make_key(buffer + '_retry'), *[json.dumps(item, default=str) for item in items])
+
+
+def requeue_retries(buffer: str, flush_method: str, queue: str='short'):
+	"""Move items parked by `retry_later` back to the buffer and queue a job to flush it.
+	"""
+	cache = frappe.cache()
+	pipe = cache.pipeline()
+	pipe.lrange(cache.make_key(buffer + '_retry'), 0, -1)
+	pipe.delete(cache.make_key(buffer + '_retry'))
+	items, _ = pipe.execute()
+	if not items:
+		return
+
+	cache.rpush(cache.make_key(buffer), *items)
+	if cache.set(cache.make_key(buffer + '_flush_queued'), 1, nx=True, ex=300):
+		frappe.enqueue(flush_method, queue=queue)
+
+
+def publish_status_updates(event: str, updates: list, room: str, batch_size: int=500):
+	"""Publish compact status changes to a realtime room, in a few events per batch
+	instead of one event per document. Events are emitted once the transaction is committed.
+	"""
+	for i in range(0, len(updates), batch_size):
+		frappe.publish_realtime(event, {'updates': updates[i:i + batch_size]}, room=room, after_commit=True)
+
+
+def set_once(key: str, expires_in_sec: int=24 * 60 * 60):
+	"""Returns True only for the first caller with the given key (within the expiry time).
+	Used to drop webhooks that twilio retries.
+	"""
+	cache = frappe.cache()
+	return bool(cache.set(cache.make_key(key), 1, nx=True, ex=expires_in_sec))